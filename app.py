@@ -1,10 +1,36 @@
-from flask import Flask, render_template, request, session, jsonify, g, redirect, url_for
+from flask import Flask, Response, render_template, request, session, jsonify, g, redirect, url_for, has_request_context
+from itsdangerous import URLSafeSerializer, BadSignature
 import sqlite3
+import abc
 import datetime
 import re
 import os
 import logging
 import sys
+import queue
+import threading
+import time
+import json
+import hashlib
+import atexit
+import bisect
+import hmac
+import math
+import gzip
+import csv
+import io
+import itertools
+import mimetypes
+from collections import OrderedDict, deque
+try:
+    import resource
+except ImportError:  # not available on Windows: process memory is then not reported
+    resource = None
+try:
+    import brotli
+except ImportError:  # optional: static assets are then precompressed with gzip only
+    brotli = None
+from sandbox import HIDDEN_TABLES, ProcessSandbox, execute_page, player_authorizer, stream_rows
 
 app = Flask(__name__)
 
@@ -14,7 +40,79 @@ app.secret_key = os.environ.get('SECRET_KEY', 'super_secret_key_change_this_for_
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.environ.get('DB_PATH', os.path.join(BASE_DIR, 'database.db'))
 print(f" * Using database: {DB_PATH}")
+# Game-state storage tuning, applied at startup and to every connection
+DB_JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL').upper()
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL').upper()
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(64 * 1024 * 1024)))
+DB_CACHE_SIZE = int(os.environ.get('DB_CACHE_SIZE', '-16000'))  # negative = KiB, positive = pages
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', '256'))
 IS_PROD = os.environ.get('FLASK_ENV') == 'production'
+# Persistent read-only connections kept open for player SQL (/api/query)
+QUERY_POOL_SIZE = int(os.environ.get('QUERY_POOL_SIZE', '8'))
+# Execution budget for a single player query: wall-clock and SQLite VM instructions
+QUERY_TIMEOUT_MS = int(os.environ.get('QUERY_TIMEOUT_MS', '2000'))
+QUERY_MAX_STEPS = int(os.environ.get('QUERY_MAX_STEPS', '50000000'))
+QUERY_PROGRESS_INTERVAL = 1000  # VM instructions between budget checks
+QUERY_PAGE_SIZE = int(os.environ.get('QUERY_PAGE_SIZE', '50'))
+# Streaming exports (/api/export): row cap and a wall-clock budget covering the whole download
+EXPORT_MAX_ROWS = int(os.environ.get('EXPORT_MAX_ROWS', '100000'))
+EXPORT_TIMEOUT_MS = int(os.environ.get('EXPORT_TIMEOUT_MS', '10000'))
+EXPORT_STALL_SECONDS = float(os.environ.get('EXPORT_STALL_SECONDS', '30'))
+EXPORT_BATCH_ROWS = 500  # rows fetched and written per chunk
+# Columnar /api/query responses larger than this are gzip-compressed for clients that accept it
+QUERY_GZIP_MIN_BYTES = int(os.environ.get('QUERY_GZIP_MIN_BYTES', '1024'))
+QUERY_GZIP_LEVEL = 5  # result JSON is repetitive; higher levels cost CPU for little gain
+# Where player SQL reads the mystery tables: 'disk' (database.db) or 'memory' (copy loaded at startup;
+# run gunicorn with --preload so forked workers share it copy-on-write)
+MYSTERY_DB_MODE = os.environ.get('MYSTERY_DB_MODE', 'disk')
+# Where player SQL runs: 'thread' (pooled connections in the web worker) or 'process' (sandbox processes)
+QUERY_BACKEND = os.environ.get('QUERY_BACKEND', 'thread')
+SANDBOX_MEMORY_MB = int(os.environ.get('SANDBOX_MEMORY_MB', '256'))  # RLIMIT_AS per sandbox process
+SANDBOX_CPU_SECONDS = int(os.environ.get('SANDBOX_CPU_SECONDS', str(QUERY_TIMEOUT_MS // 1000 + 1)))  # per statement
+SANDBOX_RECYCLE_MB = int(os.environ.get('SANDBOX_RECYCLE_MB', '192'))  # replace a process whose peak RSS passes this
+SANDBOX_GRACE_SECONDS = float(os.environ.get('SANDBOX_GRACE_SECONDS', '1.0'))  # wait beyond QUERY_TIMEOUT_MS
+# Per-player admission control for /api/query: token bucket, in-flight limit and a fair wait queue
+QUERY_RATE_PER_SEC = float(os.environ.get('QUERY_RATE_PER_SEC', '2'))
+QUERY_BURST = int(os.environ.get('QUERY_BURST', '10'))
+QUERY_USER_CONCURRENCY = int(os.environ.get('QUERY_USER_CONCURRENCY', '1'))
+QUERY_QUEUE_MAX = int(os.environ.get('QUERY_QUEUE_MAX', str(4 * QUERY_POOL_SIZE)))
+QUERY_QUEUE_TIMEOUT = float(os.environ.get('QUERY_QUEUE_TIMEOUT', '3.0'))
+# Result cache for player queries: per-worker LRU backed by a file shared by all workers
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('QUERY_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+QUERY_CACHE_PATH = os.environ.get('QUERY_CACHE_PATH', os.path.join(BASE_DIR, 'query_cache.db'))  # '' disables
+QUERY_CACHE_SHARED_MAX_BYTES = int(os.environ.get('QUERY_CACHE_SHARED_MAX_BYTES', str(128 * 1024 * 1024)))
+DATASET_CHECK_INTERVAL = float(os.environ.get('DATASET_CHECK_INTERVAL', '1.0'))
+# Per-query counters are buffered and written in batches (max lag in seconds / pending increments)
+COUNTER_FLUSH_INTERVAL = float(os.environ.get('COUNTER_FLUSH_INTERVAL', '2.0'))
+COUNTER_FLUSH_THRESHOLD = int(os.environ.get('COUNTER_FLUSH_THRESHOLD', '200'))
+# Contest event log, written behind in batches like the counters (max lag in seconds / pending events)
+EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL', '2.0'))
+EVENT_FLUSH_THRESHOLD = int(os.environ.get('EVENT_FLUSH_THRESHOLD', '500'))
+EVENT_SQL_MAX_CHARS = 2000  # player SQL kept per query event
+# Seconds between checks for leaderboard changes made by other worker processes
+LEADERBOARD_RESYNC_INTERVAL = float(os.environ.get('LEADERBOARD_RESYNC_INTERVAL', '5.0'))
+# Public /analytics page: snapshot lifetime and rows per page
+ANALYTICS_TTL_SECONDS = float(os.environ.get('ANALYTICS_TTL_SECONDS', '5'))
+ANALYTICS_PAGE_SIZE = int(os.environ.get('ANALYTICS_PAGE_SIZE', '50'))
+# Static assets: fingerprinted URLs (?v=<hash>) are cached by browsers for this long, as immutable
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', str(365 * 24 * 3600)))
+# Admin dashboard push channel (Server-Sent Events); needs threaded workers (gunicorn --threads)
+ADMIN_SSE_ENABLED = os.environ.get('ADMIN_SSE_ENABLED', '1') == '1'
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_COALESCE_SECONDS = float(os.environ.get('SSE_COALESCE_SECONDS', '0.5'))
+SSE_MAX_DURATION = float(os.environ.get('SSE_MAX_DURATION', '300'))  # clients reconnect after this
+# Browser/proxy cache lifetime for /api/schema (the mystery schema is the same for every player)
+SCHEMA_CACHE_MAX_AGE = int(os.environ.get('SCHEMA_CACHE_MAX_AGE', '3600'))
+# Player query statistics: distinct shapes kept per worker, and the slow-query ring buffer
+QUERY_STATS_SHAPES = int(os.environ.get('QUERY_STATS_SHAPES', '500'))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '250'))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', '200'))
+# Bearer token for scraping /metrics without an admin session ('' = admin session only)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Length of a player's session, counted from registration or an admin reset
+ROUND_LIMIT_SECONDS = int(os.environ.get('ROUND_LIMIT_SECONDS', '3600'))
 
 # Admin Configuration
 ADMIN_USER = os.environ.get('ADMIN_USER', 'QCA')
@@ -37,19 +135,1666 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Database Helper ---
+JOURNAL_MODES = ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'OFF')
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+def configure_connection(conn, read_only=False):
+    """Apply the per-connection storage settings from the environment"""
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size = {DB_CACHE_SIZE}')
+    if not read_only:
+        conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+    return conn
+
+def _record_db_time(started):
+    """Add the time since `started` to the current request's time inside SQLite"""
+    if has_request_context():
+        g.db_time = g.get('db_time', 0.0) + (time.perf_counter() - started)
+
+def _timed(method):
+    def timed(self, *args):
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                # Raised only once busy_timeout has run out
+                metrics.incr('db_lock_errors')
+            raise
+        finally:
+            _record_db_time(started)
+    timed.__name__ = method.__name__
+    return timed
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that charges statement execution and fetches to the request's DB time"""
+    execute = _timed(sqlite3.Cursor.execute)
+    executemany = _timed(sqlite3.Cursor.executemany)
+    fetchone = _timed(sqlite3.Cursor.fetchone)
+    fetchmany = _timed(sqlite3.Cursor.fetchmany)
+    fetchall = _timed(sqlite3.Cursor.fetchall)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements and commits are timed, see TimedCursor"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    commit = _timed(sqlite3.Connection.commit)
+
+def connect_game_db(path=DB_PATH, **kwargs):
+    """Open a configured read-write connection to the game-state database"""
+    kwargs.setdefault('factory', TimedConnection)
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=DB_STATEMENT_CACHE, **kwargs)
+    return configure_connection(conn)
+
+def configure_database():
+    """Startup check: set the persistent journal mode and report effective settings"""
+    if DB_JOURNAL_MODE not in JOURNAL_MODES:
+        raise ValueError(f"DB_JOURNAL_MODE must be one of {JOURNAL_MODES}, got {DB_JOURNAL_MODE}")
+    if DB_SYNCHRONOUS not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"DB_SYNCHRONOUS must be one of {SYNCHRONOUS_LEVELS}, got {DB_SYNCHRONOUS}")
+    if not os.path.exists(DB_PATH):
+        logger.warning(f"Database not found at {DB_PATH}; run init_db.py")
+        return {}
+    conn = connect_game_db()
+    try:
+        conn.execute(f'PRAGMA journal_mode = {DB_JOURNAL_MODE}')
+        settings = {
+            pragma: conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+            for pragma in ('journal_mode', 'busy_timeout', 'synchronous', 'mmap_size', 'cache_size')
+        }
+    finally:
+        conn.close()
+    settings['cached_statements'] = DB_STATEMENT_CACHE
+    if settings['journal_mode'].upper() != DB_JOURNAL_MODE:
+        logger.warning(f"Requested journal_mode {DB_JOURNAL_MODE} but database reports {settings['journal_mode']}")
+    logger.info(f"Game-state storage settings: {settings}")
+    return settings
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
         logger.debug(f"Connecting to database: {DB_PATH}")
-        db = g._database = sqlite3.connect(DB_PATH)
+        db = g._database = connect_game_db()
         db.row_factory = sqlite3.Row
     return db
 
+# --- Player SQL Sandbox ---
+# The authorizer and HIDDEN_TABLES live in sandbox.py, shared with the sandbox processes
+_SQL_STATEMENT_END = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?(?:\*/|$)|;", re.S)
+
+def is_single_statement(sql):
+    """True unless a ';' outside literals and comments is followed by more SQL"""
+    body = sql.strip().rstrip(';')
+    return not any(m.group(0) == ';' for m in _SQL_STATEMENT_END.finditer(body))
+
+# --- In-Memory Mystery Dataset ---
+def process_memory():
+    """Memory of this process in bytes, split into shared and private pages where /proc allows"""
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except OSError:
+        if resource is None:
+            return {}
+        # No /proc: peak RSS only (bytes on macOS, KiB elsewhere)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'max_rss': peak if sys.platform == 'darwin' else peak * 1024}
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
+
+class MemoryDataset:
+    """Mystery tables copied into a shared-cache in-memory database.
+
+    Loaded from database.db with the backup API, minus HIDDEN_TABLES, so
+    player SQL never reads the file that holds game state. A keeper
+    connection keeps the database alive and pooled connections open it by
+    name. Loaded in the gunicorn master under --preload, its pages are
+    shared copy-on-write by every forked worker; a reload after the dataset
+    changes on disk happens per worker and is private to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.uri = None
+        self.generation = 0
+        self.info = {}
+        self._keeper = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        started = time.perf_counter()
+        with self._lock:
+            self.generation += 1
+            uri = f'file:mystery_dataset_{self.generation}?mode=memory&cache=shared'
+            keeper = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+            source = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            try:
+                source.backup(keeper)
+            finally:
+                source.close()
+            for table in HIDDEN_TABLES:
+                keeper.execute(f'DROP TABLE IF EXISTS "{table}"')
+            keeper.execute('VACUUM')
+            page_count = keeper.execute('PRAGMA page_count').fetchone()[0]
+            page_size = keeper.execute('PRAGMA page_size').fetchone()[0]
+            previous, self._keeper, self.uri = self._keeper, keeper, uri
+            self.info = {
+                'bytes': page_count * page_size,
+                'load_seconds': round(time.perf_counter() - started, 4),
+                'loaded_by': os.getpid()
+            }
+        if previous is not None:
+            # Connections still checked out keep the old copy alive until released
+            previous.close()
+        memory = process_memory()
+        logger.info(f"Loaded mystery dataset into memory: {self.info['bytes'] / 2**20:.1f} MiB in "
+                    f"{self.info['load_seconds'] * 1000:.0f} ms, process RSS "
+                    f"{memory.get('rss', memory.get('max_rss', 0)) / 2**20:.1f} MiB")
+        return self.info
+
+    def connect(self, **kwargs):
+        if self.uri is None:
+            self.load()
+        conn = sqlite3.connect(self.uri, uri=True, **kwargs)
+        # mode=ro does not apply to memory databases; the authorizer denies writes as well
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    def stats(self):
+        return dict(self.info, generation=self.generation)
+
+
+mystery_memory = MemoryDataset(DB_PATH)
+
+class PooledConnection(TimedConnection):
+    """Connection that remembers which pool generation opened it."""
+    generation = 0
+    denied = None  # last authorizer denial, see player_authorizer
+
+
+class ReadOnlyPool:
+    """Pool of persistent read-only connections used for player SQL.
+
+    Player queries never share a connection with the read-write game-state
+    connection from get_db(), so they neither pay connect/teardown cost per
+    request nor take part in the write lock held by participant updates.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.generation = 0
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        options = dict(check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                       cached_statements=DB_STATEMENT_CACHE, isolation_level=None, factory=PooledConnection)
+        if MYSTERY_DB_MODE == 'memory':
+            conn = mystery_memory.connect(**options)
+        else:
+            # mode=ro rather than immutable=1: the same file also holds game state
+            # that keeps changing, and immutable would let SQLite skip locking.
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, **options)
+            configure_connection(conn, read_only=True)
+        conn.set_authorizer(player_authorizer(conn))
+        conn.row_factory = sqlite3.Row
+        conn.generation = self.generation
+        return conn
+
+    def acquire(self, timeout=10):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get(timeout=timeout)
+
+    def release(self, conn):
+        if conn.generation != self.generation:
+            conn.close()
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        """Drop a broken connection so a fresh one is opened on next acquire."""
+        with self._lock:
+            if conn.generation == self.generation:
+                self._created -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def reset(self):
+        """Reopen all connections, e.g. after database.db was rebuilt on disk.
+
+        Idle connections are closed now; checked-out ones when released.
+        """
+        with self._lock:
+            self.generation += 1
+            self._created = 0
+            stale = []
+            while True:
+                try:
+                    stale.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+        for conn in stale:
+            conn.close()
+
+    def stats(self):
+        return {'connections': self._created, 'idle': self._idle.qsize()}
+
+
+query_pool = ReadOnlyPool(DB_PATH, QUERY_POOL_SIZE)
+
+def get_query_db():
+    """Borrow a read-only connection for the current request."""
+    conn = getattr(g, '_query_db', None)
+    if conn is None:
+        conn = g._query_db = query_pool.acquire()
+    return conn
+
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db is not None:
         db.close()
+    release_query_db()
+
+def release_query_db():
+    """Return the request's read-only connection to the pool, if it borrowed one"""
+    query_db = g.pop('_query_db', None)
+    if query_db is not None:
+        query_pool.release(query_db)
+
+# --- Query Budget ---
+class Counters:
+    """Thread-safe named counters and histograms for this worker process.
+
+    Reported as JSON to admins (/api/admin/metrics) and in Prometheus text
+    format on /metrics. Labels are keyword arguments.
+    """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    ROW_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500)
+
+    def __init__(self):
+        self._values = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0
+                }
+            histogram['counts'][bisect.bisect_left(histogram['buckets'], value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {_series_name(name, labels): value for (name, labels), value in self._values.items()}
+
+    def prometheus(self, prefix, counters=(), gauges=(), **const_labels):
+        """Prometheus text exposition of every series plus extra (name, value, labels) counters and gauges"""
+        const = tuple(sorted(const_labels.items()))
+        with self._lock:
+            values = self._values.copy()
+            histograms = sorted((key, dict(h, counts=list(h['counts']))) for key, h in self._histograms.items())
+        for name, value, labels in counters:
+            values[(name, tuple(sorted(labels.items())))] = value
+        values = sorted(values.items())
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+        for (name, labels), value in values:
+            metric = f'{prefix}{name}_total'
+            declare(metric, 'counter')
+            lines.append(f'{_series_name(metric, const + labels)} {value}')
+        for (name, labels), histogram in histograms:
+            metric = f'{prefix}{name}'
+            declare(metric, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ('+Inf',), histogram['counts']):
+                cumulative += count
+                lines.append(f"{_series_name(metric + '_bucket', const + labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{_series_name(metric + '_sum', const + labels)} {histogram['sum']}")
+            lines.append(f"{_series_name(metric + '_count', const + labels)} {histogram['count']}")
+        for name, value, labels in gauges:
+            metric = f'{prefix}{name}'
+            declare(metric, 'gauge')
+            lines.append(f'{_series_name(metric, const + tuple(sorted(labels.items())))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _series_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{_label_value(value)}"' for key, value in labels) + '}'
+
+
+metrics = Counters()
+
+def budget_exceeded_response(limit):
+    """Reply for a player query stopped by its budget ('time', 'instructions', 'cpu' or 'memory')"""
+    metrics.incr('query_budget_exceeded')
+    metrics.incr(f'query_budget_exceeded_{limit}')
+    if limit == 'memory':
+        budget = f'{SANDBOX_MEMORY_MB} MB of memory'
+    else:
+        budget = f'{QUERY_TIMEOUT_MS} ms / {QUERY_MAX_STEPS} instructions'
+    return {
+        'error': f'Query exceeded budget ({budget}). Narrow it down with WHERE or LIMIT.',
+        'code': 'QUERY_BUDGET_EXCEEDED',
+        'limit': limit,
+        'results': []
+    }
+
+# --- Admission Control ---
+class QueryAdmission:
+    """Per-player rate limit and fair scheduling of player query executions.
+
+    Every /api/query request takes a token from the player's bucket. An
+    execution (a result-cache miss) then needs one of `slots` execution
+    slots, one per pooled connection, and a player may hold or wait for at
+    most `per_user` of them. When all slots are busy, waiting players are
+    served round-robin, one execution each, so a player hammering several
+    tabs waits behind everyone else instead of ahead of them.
+
+    The state is per worker process. Refusals return the seconds to wait
+    before retrying; acquire() also says why, keyed into REFUSALS.
+    """
+
+    REFUSALS = {
+        'concurrency': 'Your previous query is still running.',
+        'queue_full': 'The query queue is busy.',
+        'queue_timeout': 'The query queue is busy.',
+        'sandbox_busy': 'All query sandboxes are busy.'
+    }
+
+    def __init__(self, rate, burst, per_user, slots, queue_max, queue_timeout):
+        self.rate = rate
+        self.burst = burst
+        self.per_user = per_user
+        self.slots = slots
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self._buckets = {}             # user -> (tokens, monotonic time of last refill)
+        self._active = {}              # user -> executions running or waiting
+        self._running = 0
+        self._waiting = OrderedDict()  # user -> deque of waiters, in round-robin order
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    def take_token(self, user):
+        """0 if the request may proceed, otherwise seconds until the bucket has a token"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(user, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[user] = (tokens - 1, now)
+                return 0
+            self._buckets[user] = (tokens, now)
+        metrics.incr('query_rejections', reason='rate')
+        return (1 - tokens) / self.rate
+
+    def acquire(self, user):
+        """Wait for an execution slot.
+
+        Returns (0, None) once admitted (call release), otherwise the seconds
+        to back off and the refusal reason.
+        """
+        with self._lock:
+            if self._active.get(user, 0) >= self.per_user:
+                reason = 'concurrency'
+            elif self._running < self.slots and not self._queued:
+                self._admit(user)
+                return 0, None
+            elif self._queued >= self.queue_max:
+                reason = 'queue_full'
+            else:
+                waiter = {'event': threading.Event(), 'granted': False}
+                self._waiting.setdefault(user, deque()).append(waiter)
+                self._active[user] = self._active.get(user, 0) + 1
+                self._queued += 1
+                reason = None
+        if reason:
+            metrics.incr('query_rejections', reason=reason)
+            return 1.0, reason
+
+        started = time.monotonic()
+        waiter['event'].wait(self.queue_timeout)
+        with self._lock:
+            if not waiter['granted']:
+                waiters = self._waiting[user]
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiting[user]
+                self._queued -= 1
+                self._done(user)
+        metrics.observe('query_queue_wait_seconds', time.monotonic() - started)
+        if not waiter['granted']:
+            metrics.incr('query_rejections', reason='queue_timeout')
+            return self.queue_timeout, 'queue_timeout'
+        return 0, None
+
+    def release(self, user):
+        with self._lock:
+            self._running -= 1
+            self._done(user)
+            if self._waiting and self._running < self.slots:
+                next_user, waiters = next(iter(self._waiting.items()))
+                waiter = waiters.popleft()
+                del self._waiting[next_user]
+                if waiters:
+                    self._waiting[next_user] = waiters  # back of the line
+                self._queued -= 1
+                self._running += 1
+                waiter['granted'] = True
+                waiter['event'].set()
+
+    def _admit(self, user):
+        self._active[user] = self._active.get(user, 0) + 1
+        self._running += 1
+
+    def _done(self, user):
+        if self._active.get(user, 0) <= 1:
+            self._active.pop(user, None)
+        else:
+            self._active[user] -= 1
+
+    def forget(self, user):
+        """Drop a player's rate-limit history, e.g. when an admin deletes them"""
+        with self._lock:
+            self._buckets.pop(user, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limits': {
+                    'rate_per_sec': self.rate,
+                    'burst': self.burst,
+                    'per_user_concurrency': self.per_user,
+                    'slots': self.slots,
+                    'queue_max': self.queue_max,
+                    'queue_timeout': self.queue_timeout
+                },
+                'running': self._running,
+                'queued': self._queued,
+                'waiting': {user: len(waiters) for user, waiters in self._waiting.items()}
+            }
+
+
+query_admission = QueryAdmission(QUERY_RATE_PER_SEC, QUERY_BURST, QUERY_USER_CONCURRENCY,
+                                 QUERY_POOL_SIZE, QUERY_QUEUE_MAX, QUERY_QUEUE_TIMEOUT)
+
+def rate_limited_response(retry_after, message):
+    """429 with a Retry-After hint the terminal shows to the player"""
+    retry_after = max(1, math.ceil(retry_after))
+    response = jsonify({
+        'error': f'{message} Retry in {retry_after}s.',
+        'code': 'RATE_LIMITED',
+        'retry_after': retry_after,
+        'results': []
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+# --- Result Pages ---
+page_tokens = URLSafeSerializer(app.secret_key, salt='query-page')
+
+process_sandbox = ProcessSandbox(DB_PATH, QUERY_POOL_SIZE, SANDBOX_MEMORY_MB, SANDBOX_CPU_SECONDS,
+                                 SANDBOX_RECYCLE_MB)
+atexit.register(process_sandbox.close)
+
+def execute_player_sql(sql, offset=0, columns=None, page_size=QUERY_PAGE_SIZE):
+    """Run one page of player SQL on the configured backend; see sandbox.execute_page for the result"""
+    job = {
+        'sql': sql, 'offset': offset, 'columns': columns, 'page_size': page_size,
+        'timeout_ms': QUERY_TIMEOUT_MS, 'max_steps': QUERY_MAX_STEPS, 'progress_interval': QUERY_PROGRESS_INTERVAL
+    }
+    if QUERY_BACKEND == 'process':
+        started = time.perf_counter()
+        try:
+            return process_sandbox.run(job, timeout=QUERY_TIMEOUT_MS / 1000 + SANDBOX_GRACE_SECONDS)
+        finally:
+            _record_db_time(started)
+    # Player SQL runs on a pooled read-only connection, never the game-state one
+    return execute_page(get_query_db(), **job)
+
+def next_page_token(sql, offset, columns):
+    return page_tokens.dumps({'sql': sql, 'offset': offset, 'columns': columns})
+
+def columnar_response(page):
+    """Serialize a columnar result page in one json.dumps call, gzip-compressed past QUERY_GZIP_MIN_BYTES"""
+    body = json.dumps(page, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    response = app.response_class(mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if len(body) >= QUERY_GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        body = gzip.compress(body, compresslevel=QUERY_GZIP_LEVEL)
+        response.content_encoding = 'gzip'
+    response.set_data(body)
+    metrics.incr('query_response_bytes', len(body), encoding=response.content_encoding or 'identity')
+    return response
+
+# --- Result Cache ---
+_SQL_WHITESPACE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`(?:[^`]|``)*`|--[^\n]*|/\*.*?(?:\*/|$)|\s+", re.S)
+# Functions whose result changes between runs of the same SQL; such queries are never cached
+_SQL_NONDETERMINISTIC = re.compile(
+    r"\b(?:random|randomblob|changes|total_changes|last_insert_rowid)\s*\(|"
+    r"\bcurrent_(?:date|time|timestamp)\b|'now'", re.I)
+
+def normalize_sql(sql):
+    """Drop comments, collapse whitespace outside string literals and drop trailing semicolons"""
+    def replace(m):
+        token = m.group(0)
+        return ' ' if token[0].isspace() or token[:2] in ('--', '/*') else token
+    # Second pass joins the whitespace left on both sides of a removed comment
+    sql = _SQL_WHITESPACE.sub(replace, _SQL_WHITESPACE.sub(replace, sql))
+    return sql.strip().rstrip(';').rstrip()
+
+def is_deterministic_sql(sql):
+    """False for SQL calling random(), 'now' date functions and the like"""
+    return not _SQL_NONDETERMINISTIC.search(normalize_sql(sql))
+
+class DatasetVersion:
+    """Identity of the mystery dataset currently on disk.
+
+    Built from the file identity plus the user_version stamp init_db.py
+    writes and the schema cookie, so game-state writes to the same file do
+    not change it but rebuilding or re-importing the dataset does. Checked at
+    most every DATASET_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.current = None
+        self._checked_at = 0.0
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def on_change(self, callback):
+        self._listeners.append(callback)
+        return callback
+
+    def _read(self):
+        st = os.stat(self.path)
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            user_version = conn.execute('PRAGMA user_version').fetchone()[0]
+            schema_version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        finally:
+            conn.close()
+        return f"{st.st_dev}:{st.st_ino}:{user_version}:{schema_version}"
+
+    def get(self):
+        now = time.monotonic()
+        if self.current is not None and now - self._checked_at < DATASET_CHECK_INTERVAL:
+            return self.current
+        with self._lock:
+            if self.current is not None and now - self._checked_at < DATASET_CHECK_INTERVAL:
+                return self.current
+            version = self._read()
+            self._checked_at = now
+            previous, self.current = self.current, version
+        if previous is not None and version != previous:
+            logger.info(f"Mystery dataset changed ({previous} -> {version})")
+            for callback in self._listeners:
+                callback(version)
+        return version
+
+
+dataset_version = DatasetVersion(DB_PATH)
+
+class ResultCache:
+    """Normalized-SQL -> result page cache for the immutable mystery tables.
+
+    Tier one is a per-worker LRU bounded by QUERY_CACHE_MAX_BYTES, so a
+    repeated query costs a dictionary lookup. Tier two is a small SQLite file
+    shared by every gunicorn worker on the host, bounded by
+    QUERY_CACHE_SHARED_MAX_BYTES and evicted least-recently-used. Keys include
+    the dataset version, so entries only go stale when the mystery DB does.
+    """
+
+    def __init__(self, max_bytes, shared_path=None, shared_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.shared_path = shared_path
+        self.shared_max_bytes = shared_max_bytes
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._shared = None
+        self._shared_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(version, sql, offset, page_size):
+        raw = f"{version}\0{normalize_sql(sql)}\0{offset}\0{page_size}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(payload)
+        payload = self._shared_get(key)
+        if payload is not None:
+            self._store_local(key, payload)
+            with self._lock:
+                self.shared_hits += 1
+            return json.loads(payload)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        try:
+            payload = json.dumps(value, separators=(',', ':'))
+        except (TypeError, ValueError):
+            return  # BLOB results are not cacheable
+        self._store_local(key, payload)
+        self._shared_put(key, payload)
+
+    def _store_local(self, key, payload):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = payload
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self, version=None):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if version is not None:
+            self._shared_call(lambda conn: conn.execute('DELETE FROM results WHERE version != ?', (version,)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses
+            }
+
+    # Shared tier: a failure only costs a cache miss, never the query
+    def _shared_call(self, fn):
+        if not self.shared_path:
+            return None
+        with self._shared_lock:
+            try:
+                if self._shared is None:
+                    conn = sqlite3.connect(self.shared_path, timeout=0.5, check_same_thread=False,
+                                           isolation_level=None)
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.execute('PRAGMA synchronous=OFF')
+                    conn.execute('''
+                        CREATE TABLE IF NOT EXISTS results (
+                            key TEXT PRIMARY KEY,
+                            version TEXT,
+                            payload TEXT,
+                            size INTEGER,
+                            last_used REAL
+                        )
+                    ''')
+                    conn.execute('CREATE INDEX IF NOT EXISTS idx_results_last_used ON results (last_used)')
+                    self._shared = conn
+                return fn(self._shared)
+            except sqlite3.Error as e:
+                logger.warning(f"Shared query cache unavailable: {e}")
+                return None
+
+    def _shared_get(self, key):
+        def lookup(conn):
+            row = conn.execute('SELECT payload FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+        return self._shared_call(lookup)
+
+    def _shared_put(self, key, payload):
+        def store(conn):
+            conn.execute('INSERT OR REPLACE INTO results (key, version, payload, size, last_used) VALUES (?, ?, ?, ?, ?)',
+                         (key, dataset_version.current, payload, len(payload), time.time()))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total > self.shared_max_bytes:
+                # Evict least recently used entries until back under the bound
+                conn.execute('''
+                    DELETE FROM results WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY last_used DESC) AS running FROM results
+                        ) WHERE running > ?
+                    )
+                ''', (self.shared_max_bytes,))
+        self._shared_call(store)
+
+
+result_cache = ResultCache(QUERY_CACHE_MAX_BYTES, QUERY_CACHE_PATH, QUERY_CACHE_SHARED_MAX_BYTES)
+
+@dataset_version.on_change
+def _invalidate_dataset(version):
+    if MYSTERY_DB_MODE == 'memory':
+        mystery_memory.load()
+    query_pool.reset()
+    process_sandbox.reset()
+    result_cache.clear(version)
+
+# --- Write-Behind Counters ---
+class WriteBehind(abc.ABC):
+    """Background flusher shared by the write-behind buffers.
+
+    Subclasses implement flush(); it runs every `interval` seconds, or as
+    soon as wake() is called, on a thread started lazily per process.
+    """
+
+    thread_name = 'write-behind'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def flush(self):
+        """Write out what is pending; returns the number of items written"""
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Started lazily so each forked gunicorn worker runs its own flusher
+        if self._thread_pid == os.getpid():
+            return
+        with self._thread_lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name=self.thread_name, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class CounterBuffer(WriteBehind):
+    """Write-behind buffer for high-frequency participant counters.
+
+    Increments are kept in memory and applied in one batched transaction
+    every COUNTER_FLUSH_INTERVAL seconds, or sooner once
+    COUNTER_FLUSH_THRESHOLD increments are pending. Stored counts lag the
+    true ones by at most one interval; a final flush runs at process exit.
+    """
+
+    COLUMNS = ('query_count',)
+    thread_name = 'counter-flush'
+
+    def __init__(self, path, interval, threshold):
+        super().__init__(interval)
+        self.path = path
+        self.threshold = threshold
+        self._pending = {}
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, name, column='query_count', amount=1):
+        if column not in self.COLUMNS:
+            raise ValueError(f"Unknown counter column: {column}")
+        with self._lock:
+            key = (column, name)
+            self._pending[key] = self._pending.get(key, 0) + amount
+            self._pending_total += amount
+            over_threshold = self._pending_total >= self.threshold
+        self._ensure_thread()
+        if over_threshold:
+            self.wake()
+
+    def pending_total(self):
+        with self._lock:
+            return self._pending_total
+
+    def pending(self, name, column='query_count'):
+        with self._lock:
+            return self._pending.get((column, name), 0)
+
+    def discard(self, name):
+        """Forget unflushed increments, e.g. when an admin resets the user"""
+        with self._lock:
+            for key in [k for k in self._pending if k[1] == name]:
+                self._pending_total -= self._pending.pop(key)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._pending_total = 0
+            if not batch:
+                return 0
+            try:
+                conn = connect_game_db(self.path)
+                try:
+                    with conn:
+                        for column in self.COLUMNS:
+                            conn.executemany(f'UPDATE participants SET {column} = {column} + ? WHERE name = ?',
+                                             [(delta, name) for (col, name), delta in batch.items() if col == column])
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                # Put the batch back; it goes out with the next flush
+                logger.warning(f"Counter flush failed, retrying later: {e}")
+                metrics.incr('counter_flush_retries')
+                with self._lock:
+                    for key, delta in batch.items():
+                        self._pending[key] = self._pending.get(key, 0) + delta
+                        self._pending_total += delta
+                return 0
+            metrics.incr('counter_flushes')
+            return len(batch)
+
+
+counter_buffer = CounterBuffer(DB_PATH, COUNTER_FLUSH_INTERVAL, COUNTER_FLUSH_THRESHOLD)
+atexit.register(counter_buffer.flush)
+
+# --- Contest Event Log ---
+class EventLog(WriteBehind):
+    """Append-only history of the contest in the contest_events table.
+
+    Logins, queries, verify attempts, round advances, submissions and admin
+    actions are buffered in memory and inserted in one transaction per
+    flush, so recording an event never adds a commit to the request. Rows
+    are never updated or deleted by the app; admin resets and deletions
+    are themselves events. Events from other workers appear within
+    EVENT_FLUSH_INTERVAL seconds.
+    """
+
+    KINDS = ('login', 'query', 'verify', 'advance', 'submit', 'admin')
+    thread_name = 'event-flush'
+
+    def __init__(self, path, interval, threshold):
+        super().__init__(interval)
+        self.path = path
+        self.threshold = threshold
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def record(self, kind, name=None, **data):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown event kind: {kind}")
+        event = (time.time(), kind, name, json.dumps(data, separators=(',', ':'), default=str) if data else None)
+        with self._lock:
+            self._pending.append(event)
+            over_threshold = len(self._pending) >= self.threshold
+        self._ensure_thread()
+        if over_threshold:
+            self.wake()
+
+    def pending_total(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                conn = connect_game_db(self.path)
+                try:
+                    with conn:
+                        conn.executemany('INSERT INTO contest_events (ts, kind, name, data) VALUES (?, ?, ?, ?)', batch)
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                # Keep the batch ahead of newer events; it goes out with the next flush
+                logger.warning(f"Event log flush failed, retrying later: {e}")
+                metrics.incr('event_flush_retries')
+                with self._lock:
+                    self._pending[:0] = batch
+                return 0
+            metrics.incr('events_written', len(batch))
+            return len(batch)
+
+    def replay(self, after_id=0, kinds=None, limit=None, by_time=False):
+        """Yield stored events as dicts, reading only contest_events.
+
+        Ids are assigned when a worker flushes its batch, so id order is
+        append order but not event order across workers; by_time orders by
+        the recorded timestamp instead (ties broken by id).
+        """
+        sql = 'SELECT id, ts, kind, name, data FROM contest_events WHERE id > ?'
+        params = [after_id]
+        if kinds:
+            sql += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            params += list(kinds)
+        sql += ' ORDER BY ts, id' if by_time else ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            for event_id, ts, kind, name, data in conn.execute(sql, params):
+                yield {'id': event_id, 'ts': ts, 'kind': kind, 'name': name,
+                       'data': json.loads(data) if data else {}}
+        finally:
+            conn.close()
+
+
+event_log = EventLog(DB_PATH, EVENT_FLUSH_INTERVAL, EVENT_FLUSH_THRESHOLD)
+atexit.register(event_log.flush)
+
+def contest_report(events):
+    """Fold an event stream into per-player history and contest totals.
+
+    Expects events in time order (EventLog.replay(by_time=True)): an admin
+    reset clears the player's progress (round, solve times, submission) as
+    it does in the live tables, while activity totals keep counting across
+    resets.
+    """
+    players = {}
+    totals = {kind: 0 for kind in EventLog.KINDS}
+    first_ts = last_ts = None
+
+    def player(name):
+        return players.setdefault(name, {
+            'name': name, 'first_seen': None, 'logins': 0, 'queries': 0, 'query_ms': 0.0,
+            'query_errors': 0, 'verify_attempts': 0, 'correct_answers': 0, 'round': 1,
+            'round_times': {}, 'submission': None, 'resets': 0, 'deleted': False
+        })
+
+    for event in events:
+        kind, data, ts = event['kind'], event['data'], event['ts']
+        totals[kind] = totals.get(kind, 0) + 1
+        first_ts = ts if first_ts is None else first_ts
+        last_ts = ts
+        if kind == 'admin':
+            target = data.get('target')
+            if target is None:
+                continue
+            entry = player(target)
+            if data.get('action') == 'reset_user':
+                entry.update(round=1, round_times={}, submission=None, resets=entry['resets'] + 1, deleted=False)
+            elif data.get('action') == 'delete_user':
+                entry['deleted'] = True
+            continue
+        if event['name'] is None or data.get('admin'):
+            continue
+        entry = player(event['name'])
+        if entry['first_seen'] is None:
+            entry['first_seen'] = ts
+        if kind == 'login':
+            entry['logins'] += 1
+        elif kind == 'query':
+            # LOAD MORE pages belong to the query that opened them, as in the live query_count
+            if not data.get('offset'):
+                entry['queries'] += 1
+            entry['query_ms'] += data.get('ms', 0)
+            if data.get('outcome', 'ok') not in ('ok', 'cached'):
+                entry['query_errors'] += 1
+        elif kind == 'verify':
+            entry['verify_attempts'] += 1
+            if data.get('correct'):
+                entry['correct_answers'] += 1
+                entry['round_times'].setdefault(str(data.get('round')), ts)
+        elif kind == 'advance':
+            entry['round'] = max(entry['round'], data.get('round', 1))
+        elif kind == 'submit':
+            entry['submission'] = {'answer': data.get('answer'), 'correct': data.get('correct'), 'ts': ts}
+
+    for entry in players.values():
+        entry['query_ms'] = round(entry['query_ms'], 1)
+    ranked = sorted(players.values(), key=lambda p: (
+        not (p['submission'] or {}).get('correct'), -p['round'],
+        (p['submission'] or {}).get('ts') or float('inf'), p['name']))
+    return {'totals': totals, 'first_event': first_ts, 'last_event': last_ts, 'players': ranked}
+
+def log_query_event(user, sql, elapsed, rows=0, outcome='ok', **data):
+    event_log.record('query', user, sql=sql[:EVENT_SQL_MAX_CHARS], ms=round(elapsed * 1000, 2), rows=rows,
+                     outcome=outcome, **data)
+
+# --- Leaderboard ---
+class Leaderboard:
+    """Admin leaderboard kept in memory and updated as the game changes.
+
+    Login, verify, submit, query counts and admin resets update rows here
+    directly, so admin polls are served without touching the database. Every
+    change bumps a version number; each row remembers the version that last
+    touched it, so a poller holding version N can ask for only the rows that
+    changed since then. Versions are per process (identified by epoch);
+    writes made by other gunicorn workers are picked up by a resync from
+    the database, at most every LEADERBOARD_RESYNC_INTERVAL seconds and
+    only when the database actually changed.
+    """
+
+    def __init__(self, path, resync_interval):
+        self.path = path
+        self.resync_interval = resync_interval
+        self.epoch = os.urandom(6).hex()
+        self.version = 0
+        self.submissions_version = 0
+        self._rows = {}
+        self._row_versions = {}
+        self._removed = {}
+        self._loaded = False
+        self._synced_at = 0.0
+        self._data_version = None
+        self._conn = None
+        self._lock = threading.RLock()
+        self.changed = threading.Condition(self._lock)
+
+    # Mutations -------------------------------------------------------------
+    def _bump(self, name, submission=False):
+        self.version += 1
+        self._row_versions[name] = self.version
+        self._removed.pop(name, None)
+        if submission:
+            self.submissions_version = self.version
+        self.changed.notify_all()
+
+    def add(self, name, round_deadline, start_time):
+        with self._lock:
+            if not self._loaded:
+                return
+            self._rows[name] = self._blank_row(name, round_deadline, start_time)
+            self._bump(name)
+
+    def update(self, name, **changes):
+        with self._lock:
+            row = self._rows.get(name)
+            if row is None or all(row.get(k) == v for k, v in changes.items()):
+                return
+            row.update(changes)
+            self._bump(name, submission='submission' in changes)
+
+    def increment(self, name, field, amount=1):
+        with self._lock:
+            row = self._rows.get(name)
+            if row is not None:
+                row[field] += amount
+                self._bump(name)
+
+    def remove(self, name):
+        with self._lock:
+            row = self._rows.pop(name, None)
+            if row is None:
+                return
+            self._row_versions.pop(name, None)
+            self.version += 1
+            self._removed[name] = self.version
+            if row['submission']:
+                self.submissions_version = self.version
+            self.changed.notify_all()
+
+    # Reads -----------------------------------------------------------------
+    def wait_for_change(self, version, timeout):
+        """Block until the version moves past `version` or the timeout expires"""
+        with self._lock:
+            return self.changed.wait_for(lambda: self.version > version, timeout)
+
+    def changes_since(self, since=None, epoch=None):
+        """Full snapshot, or only what changed after version `since` of this epoch"""
+        self.ensure_fresh()
+        now = time.time()
+        with self._lock:
+            full = since is None or epoch != self.epoch or since > self.version
+            if full:
+                names = list(self._rows)
+            else:
+                names = [n for n, v in self._row_versions.items() if v > since]
+            stats = [self._public(self._rows[n], now) for n in names]
+            stats.sort(key=lambda r: (not r['solved'], -r['round'], r['elapsed']))
+            response = {
+                'epoch': self.epoch,
+                'version': self.version,
+                'full': full,
+                'server_time': now,
+                'round_limit': ROUND_LIMIT_SECONDS,
+                'stats': stats,
+                'removed': [] if full else [n for n, v in self._removed.items() if v > since]
+            }
+            if full or self.submissions_version > since:
+                response['submissions'] = self._submissions()
+            return response
+
+    def snapshot(self):
+        return self.changes_since()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _submissions(self):
+        subs = [dict(row['submission'], name=row['name']) for row in self._rows.values() if row['submission']]
+        subs.sort(key=lambda s: s['time'] or '', reverse=True)
+        return subs
+
+    @staticmethod
+    def _public(row, now):
+        if row['submitted']:
+            elapsed = row['elapsed_time'] or 0
+        else:
+            elapsed = int(min(max(0, now - row['started_at']), ROUND_LIMIT_SECONDS))
+        return {
+            'name': row['name'],
+            'round': row['round'],
+            'time': format_time(elapsed),
+            'elapsed': elapsed,
+            'started_at': None if row['submitted'] else row['started_at'],
+            'solved': row['solved'],
+            'queries': row['queries'],
+            'round1_time': row['round1_time'],
+            'round2_time': row['round2_time'],
+            'start_time': row['start_time']
+        }
+
+    @staticmethod
+    def _blank_row(name, round_deadline, start_time):
+        return {
+            'name': name,
+            'round': 1,
+            'solved': False,
+            'queries': 0,
+            'elapsed_time': 0,
+            'submitted': False,
+            'submission': None,
+            'started_at': round_deadline - ROUND_LIMIT_SECONDS,
+            'start_time': str(start_time),
+            'round1_time': '-',
+            'round2_time': '-'
+        }
+
+    # Database resync ---------------------------------------------------------
+    def ensure_fresh(self):
+        with self._lock:
+            if not self._loaded:
+                self.sync()
+            elif time.monotonic() - self._synced_at >= self.resync_interval:
+                self._synced_at = time.monotonic()
+                if self._read_data_version() != self._data_version:
+                    self.sync()
+
+    def _read_data_version(self):
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def sync(self):
+        """Rebuild from the database, bumping versions only for rows that differ"""
+        with self._lock:
+            if self._conn is None:
+                self._conn = connect_game_db(self.path, check_same_thread=False)
+                self._conn.row_factory = sqlite3.Row
+            self._data_version = self._read_data_version()
+            rows = self._load_rows(self._conn)
+            self._synced_at = time.monotonic()
+            if not self._loaded:
+                self._rows = rows
+                self._row_versions = {name: self.version for name in rows}
+                self._loaded = True
+                return
+            for name in list(self._rows):
+                if name not in rows:
+                    self.remove(name)
+            for name, row in rows.items():
+                if self._rows.get(name) != row:
+                    submission_changed = name not in self._rows or self._rows[name]['submission'] != row['submission']
+                    self._rows[name] = row
+                    self._bump(name, submission=submission_changed)
+
+    def _load_rows(self, db):
+        participants = db.execute('''
+            SELECT name, current_round, elapsed_time, solved, query_count, round_start_time, round_deadline
+            FROM participants
+        ''').fetchall()
+        submissions = {
+            s['name']: {'answer': s['final_answer'], 'correct': bool(s['solved']),
+                        'time': s['submission_time'], 'round': s['round']}
+            for s in db.execute('''
+                SELECT s.*, p.solved
+                FROM submissions s
+                JOIN participants p ON s.name = p.name
+            ''').fetchall()
+        }
+        # Round solve times (graceful fallback for legacy databases without solved_at)
+        solve_times = {}
+        try:
+            for rt in db.execute('''
+                SELECT ip.name, i.round, ip.solved_at
+                FROM investigation_progress ip
+                JOIN investigations i ON ip.investigation_id = i.id
+                WHERE ip.solved = 1
+            ''').fetchall():
+                solve_times.setdefault(rt['name'], {})[rt['round']] = rt['solved_at']
+        except sqlite3.Error as e:
+            logger.warning(f"Could not fetch solve times (run init_db.py to add solved_at column): {e}")
+
+        rows = {}
+        for p in participants:
+            name = p['name']
+            participant_solves = solve_times.get(name, {})
+            rows[name] = {
+                'name': name,
+                'round': p['current_round'],
+                'solved': bool(p['solved']),
+                'queries': p['query_count'] + counter_buffer.pending(name),
+                'elapsed_time': p['elapsed_time'],
+                'submitted': name in submissions,
+                'submission': submissions.get(name),
+                'started_at': participant_deadline(p) - ROUND_LIMIT_SECONDS,
+                'start_time': p['round_start_time'],
+                'round1_time': format_datetime(participant_solves.get(1)),
+                'round2_time': format_datetime(participant_solves.get(2))
+            }
+        return rows
+
+
+leaderboard = Leaderboard(DB_PATH, LEADERBOARD_RESYNC_INTERVAL)
+
+# --- Schema Catalog ---
+class SchemaCatalog:
+    """Player-visible schema, built once per dataset version.
+
+    Holds columns with types, row counts and indexes for every mystery
+    table, pre-serialized with a strong ETag, so /api/schema never touches
+    the database once built.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.body = None
+        self.etag = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        version = dataset_version.get()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.body = json.dumps(self._build(), separators=(',', ':'))
+                    self.etag = hashlib.sha1(self.body.encode('utf-8')).hexdigest()
+                    self.version = version
+        return self.body, self.etag
+
+    def _build(self):
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+            catalog = {}
+            for table in tables:
+                if table in HIDDEN_TABLES:
+                    continue
+                indexes = []
+                for index in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+                    indexes.append({
+                        'name': index[1],
+                        'unique': bool(index[2]),
+                        'columns': [col[2] for col in conn.execute(f'PRAGMA index_info("{index[1]}")')]
+                    })
+                catalog[table] = {
+                    'columns': [
+                        {'name': col[1], 'type': col[2], 'notnull': bool(col[3]), 'pk': bool(col[5])}
+                        for col in conn.execute(f'PRAGMA table_info("{table}")')
+                    ],
+                    'row_count': conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0],
+                    'indexes': indexes
+                }
+        finally:
+            conn.close()
+        logger.info(f"Built schema catalog for {len(catalog)} tables")
+        return catalog
+
+
+schema_catalog = SchemaCatalog(DB_PATH)
+
+# --- Investigation Catalog ---
+def normalize_answer(answer):
+    """Case- and whitespace-insensitive form used to compare answers"""
+    return ' '.join((answer or '').split()).casefold()
+
+class InvestigationCatalog:
+    """Investigations of the current contest, loaded once per dataset version.
+
+    Investigations are static during a contest, so /api/verify and
+    /api/investigations read prompts, normalized answers and per-round
+    totals from memory instead of the investigations table.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.by_id = {}
+        self.by_round = {}
+        self.last_round = 0
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        version = dataset_version.get()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self._load()
+                    self.version = version
+
+    def _load(self):
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            rows = conn.execute('SELECT id, round, prompt, correct_answer FROM investigations ORDER BY round, id').fetchall()
+        finally:
+            conn.close()
+        by_id, by_round = {}, {}
+        for inv_id, round_number, prompt, correct_answer in rows:
+            by_id[inv_id] = {
+                'id': inv_id,
+                'round': round_number,
+                'prompt': prompt,
+                'correct_answer': correct_answer,
+                'answer': normalize_answer(correct_answer)
+            }
+            by_round.setdefault(round_number, []).append(by_id[inv_id])
+        self.by_id, self.by_round = by_id, by_round
+        self.last_round = max(by_round, default=0)
+        logger.info(f"Loaded {len(by_id)} investigations across {len(by_round)} rounds")
+
+    def get(self, inv_id):
+        self._ensure_loaded()
+        try:
+            return self.by_id.get(int(inv_id))
+        except (TypeError, ValueError):
+            return None
+
+    def in_round(self, round_number):
+        self._ensure_loaded()
+        return self.by_round.get(round_number, [])
+
+    def all(self):
+        self._ensure_loaded()
+        return list(self.by_id.values())
+
+
+investigation_catalog = InvestigationCatalog(DB_PATH)
+
+# Participant's round deadline in SQL, mirroring participant_deadline() for rows that predate the column
+_DEADLINE_SQL = f"COALESCE(round_deadline, CAST(strftime('%s', round_start_time, 'utc') AS REAL) + {ROUND_LIMIT_SECONDS})"
+
+# --- Query Stats ---
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\b\d+(?:\.\d+)?\b")
+
+def fingerprint_sql(sql):
+    """Query shape: literals replaced by '?', case and whitespace folded"""
+    sql = _SQL_LITERAL.sub(lambda m: m.group(0) if m.group(0)[0] == '"' else '?', normalize_sql(sql))
+    return sql.lower()
+
+class QueryStats:
+    """Per-shape statistics for player queries, plus a ring buffer of slow executions.
+
+    Shapes are keyed by fingerprint and only the `max_shapes` most recently
+    seen are kept, so memory stays flat however many distinct queries players
+    type. Time and VM steps cover executions only; cache hits are counted
+    apart. VM steps come from the QueryBudget progress handler, so they are
+    counted in units of QUERY_PROGRESS_INTERVAL.
+    """
+
+    def __init__(self, max_shapes, slow_ms, slow_log_size):
+        self.max_shapes = max_shapes
+        self.slow_ms = slow_ms
+        self.slow = deque(maxlen=slow_log_size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, sql, user=None, elapsed=0.0, steps=0, rows=0, cached=False, outcome='ok'):
+        fingerprint = fingerprint_sql(sql)
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            entry = self._entries.pop(fingerprint, None) or {
+                'sql': sql, 'count': 0, 'cache_hits': 0, 'executions': 0, 'budget_exceeded': 0,
+                'total_ms': 0.0, 'max_ms': 0.0, 'total_steps': 0, 'max_steps': 0, 'rows': 0, 'users': {}
+            }
+            entry['count'] += 1
+            entry['rows'] += rows
+            if user:
+                entry['users'][user] = entry['users'].get(user, 0) + 1
+            if cached:
+                entry['cache_hits'] += 1
+            else:
+                entry['executions'] += 1
+                entry['total_ms'] += elapsed_ms
+                entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+                entry['total_steps'] += steps
+                entry['max_steps'] = max(entry['max_steps'], steps)
+                if outcome != 'ok':
+                    entry['budget_exceeded'] += 1
+            self._entries[fingerprint] = entry
+            while len(self._entries) > self.max_shapes:
+                self._entries.popitem(last=False)
+            slow = not cached and elapsed_ms >= self.slow_ms
+            if slow:
+                self.slow.append({
+                    'time': time.time(),
+                    'user': user,
+                    'fingerprint': fingerprint,
+                    'sql': sql[:1000],
+                    'ms': round(elapsed_ms, 1),
+                    'steps': steps,
+                    'rows': rows,
+                    'outcome': outcome
+                })
+        if slow:
+            metrics.incr('slow_queries')
+            logger.warning(f"Slow query ({elapsed_ms:.0f} ms, {outcome}) by user {user}: {fingerprint[:200]}")
+
+    def snapshot(self):
+        with self._lock:
+            return {fp: dict(entry, users=dict(entry['users'])) for fp, entry in self._entries.items()}
+
+    def report(self, limit=25):
+        """Shapes costing the most execution time, and the slow log newest first"""
+        shapes = []
+        for fingerprint, entry in self.snapshot().items():
+            executions = entry['executions']
+            top_users = sorted(entry['users'].items(), key=lambda u: -u[1])[:3]
+            shapes.append({
+                'fingerprint': fingerprint,
+                'count': entry['count'],
+                'executions': executions,
+                'cache_hits': entry['cache_hits'],
+                'budget_exceeded': entry['budget_exceeded'],
+                'total_ms': round(entry['total_ms'], 1),
+                'mean_ms': round(entry['total_ms'] / executions, 1) if executions else 0.0,
+                'max_ms': round(entry['max_ms'], 1),
+                'mean_steps': entry['total_steps'] // executions if executions else 0,
+                'max_steps': entry['max_steps'],
+                'rows': entry['rows'],
+                'users': len(entry['users']),
+                'top_users': [{'name': name, 'count': count} for name, count in top_users]
+            })
+        shapes.sort(key=lambda s: -s['total_ms'])
+        with self._lock:
+            slow = list(reversed(self.slow))
+        return {'threshold_ms': self.slow_ms, 'shapes': shapes[:limit], 'slow': slow}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.slow.clear()
+
+
+query_stats = QueryStats(QUERY_STATS_SHAPES, SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE)
+
+# --- Index Advisor ---
+_SQL_WORD = re.compile(r'[a-z_][a-z0-9_]*')
+
+class IndexAdvisor:
+    """Suggests secondary indexes for the mystery tables from sampled player queries.
+
+    Every sampled query is planned with EXPLAIN QUERY PLAN against an empty
+    in-memory copy of the mystery schema (plus sqlite_stat1, when init_db
+    ran ANALYZE). Each column of a scanned table that the query mentions is
+    then tried as a hypothetical index; an index is worth adding when it
+    removes full scans, weighted by how often the query shape was run.
+    Nothing here touches the real data, so the report is cheap to produce.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def full_scans(conn, sql):
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        return [row[3] for row in plan
+                if (row[3].startswith('SCAN ') and ' INDEX' not in row[3]) or ' AUTOMATIC ' in row[3]]
+
+    def _hypothetical_db(self):
+        """Empty in-memory copy of the mystery schema with the planner statistics"""
+        source = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        try:
+            objects = source.execute(
+                "SELECT type, tbl_name, sql FROM sqlite_master WHERE type IN ('table', 'index') "
+                "AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type = 'index'").fetchall()
+            for kind, table, create_sql in objects:
+                if table not in HIDDEN_TABLES:
+                    conn.execute(create_sql)
+            has_stats = source.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+            if has_stats:
+                conn.execute('ANALYZE')
+                conn.executemany('INSERT INTO sqlite_stat1 VALUES (?, ?, ?)', [
+                    row for row in source.execute('SELECT tbl, idx, stat FROM sqlite_stat1')
+                    if row[0] not in HIDDEN_TABLES
+                ])
+                conn.execute('ANALYZE sqlite_master')  # reload the copied statistics
+        finally:
+            source.close()
+        return conn
+
+    @staticmethod
+    def _columns(conn):
+        """Mystery columns not already leading an index, by table"""
+        columns = {}
+        for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                     "AND name NOT LIKE 'sqlite_%'").fetchall():
+            leading = set()
+            for index in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+                info = conn.execute(f'PRAGMA index_info("{index[1]}")').fetchall()
+                if info:
+                    leading.add(info[0][2])
+            columns[table.lower()] = [
+                col[1] for col in conn.execute(f'PRAGMA table_info("{table}")')
+                if col[1] not in leading and not (col[5] and col[2].upper() == 'INTEGER')
+            ]
+        return columns
+
+    def report(self, samples):
+        conn = self._hypothetical_db()
+        try:
+            columns = self._columns(conn)
+            queries, candidates = [], {}
+            for fingerprint, sample in samples.items():
+                try:
+                    scans = self.full_scans(conn, sample['sql'])
+                except sqlite3.Error:
+                    continue
+                queries.append({'fingerprint': fingerprint, 'count': sample['count'], 'full_scans': scans})
+                if not scans:
+                    continue
+                words = set(_SQL_WORD.findall(sample['sql'].lower()))
+                for table in words.intersection(columns):
+                    for column in columns[table]:
+                        if column.lower() not in words:
+                            continue
+                        name = f'idx_{table}_{column}'.lower()
+                        conn.execute(f'CREATE INDEX "{name}" ON "{table}" ("{column}")')
+                        try:
+                            removed = len(scans) - len(self.full_scans(conn, sample['sql']))
+                        finally:
+                            conn.execute(f'DROP INDEX "{name}"')
+                        if removed <= 0:
+                            continue
+                        candidate = candidates.setdefault(name, {
+                            'table': table,
+                            'columns': [column],
+                            'create_sql': f'CREATE INDEX {name} ON {table} ({column})',
+                            'scans_removed': 0,
+                            'queries': 0
+                        })
+                        candidate['scans_removed'] += removed * sample['count']
+                        candidate['queries'] += 1
+        finally:
+            conn.close()
+        queries.sort(key=lambda q: -q['count'] * len(q['full_scans']))
+        return {
+            'recommendations': sorted(candidates.values(), key=lambda c: -c['scans_removed']),
+            'queries': queries
+        }
+
+
+index_advisor = IndexAdvisor(DB_PATH)
 
 # --- Helper Functions ---
 def format_time(seconds):
@@ -61,21 +1806,183 @@ def format_time(seconds):
     s = int(seconds) % 60
     return f"{h:02}:{m:02}:{s:02}"
 
+def parse_datetime(dt_str):
+    """Parse a sqlite DATETIME string written by datetime.now(), or None"""
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(dt_str.split('+')[0], fmt)
+        except ValueError:
+            continue
+    return None
+
 def format_datetime(dt_str):
     """Format datetime string into HH:MM:SS for display"""
     if not dt_str:
         return "-"
     try:
-        for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
-            try:
-                dt = datetime.datetime.strptime(dt_str.split('+')[0], fmt)
-                return dt.strftime('%H:%M:%S')
-            except ValueError:
-                continue
-        return dt_str
+        dt = parse_datetime(dt_str)
+        return dt.strftime('%H:%M:%S') if dt else dt_str
     except:
         return "-"
 
+def participant_deadline(user, now=None):
+    """Absolute round deadline (epoch seconds) for a participants row"""
+    if user['round_deadline'] is not None:
+        return user['round_deadline']
+    # Rows created before round_deadline existed: derive it, never write on read
+    start_time = parse_datetime(user['round_start_time'] or '')
+    if start_time is None:
+        # No usable start: keep the time already spent rather than expiring the round
+        return (time.time() if now is None else now) + ROUND_LIMIT_SECONDS - (user['elapsed_time'] or 0)
+    return start_time.timestamp() + ROUND_LIMIT_SECONDS
+
+def elapsed_seconds(user, frozen=False, now=None):
+    """Seconds a participant has spent, derived from their deadline.
+
+    Once frozen (the player submitted) the stored elapsed_time is the
+    authoritative value; it is written at round advance and submission only.
+    """
+    if frozen:
+        return user['elapsed_time'] or 0
+    now = time.time() if now is None else now
+    start = participant_deadline(user, now) - ROUND_LIMIT_SECONDS
+    return int(min(max(0, now - start), ROUND_LIMIT_SECONDS))
+
+CONTEST_EVENTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS contest_events (
+        id INTEGER PRIMARY KEY,
+        ts REAL NOT NULL,
+        kind TEXT NOT NULL,
+        name TEXT,
+        data TEXT
+    )
+'''
+CONTEST_EVENTS_TS_INDEX = 'CREATE INDEX IF NOT EXISTS idx_contest_events_ts ON contest_events (ts)'
+
+def ensure_game_schema():
+    """Add game-state columns and tables missing from databases built by older init_db.py"""
+    if not os.path.exists(DB_PATH):
+        return
+    conn = connect_game_db()
+    try:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(participants)')]
+        if columns and 'round_deadline' not in columns:
+            logger.info("Adding participants.round_deadline column")
+            conn.execute('ALTER TABLE participants ADD COLUMN round_deadline REAL')
+            conn.execute("UPDATE participants SET round_deadline = CAST(strftime('%s', round_start_time, 'utc') AS REAL) + ?",
+                         (ROUND_LIMIT_SECONDS,))
+            conn.commit()
+        if columns:
+            conn.execute(CONTEST_EVENTS_SCHEMA)
+            conn.execute(CONTEST_EVENTS_TS_INDEX)
+            conn.commit()
+    finally:
+        conn.close()
+
+if MYSTERY_DB_MODE not in ('disk', 'memory'):
+    raise ValueError(f"MYSTERY_DB_MODE must be 'disk' or 'memory', got {MYSTERY_DB_MODE}")
+storage_settings = configure_database()
+ensure_game_schema()
+if os.path.exists(DB_PATH):
+    schema_catalog.get()
+    if MYSTERY_DB_MODE == 'memory':
+        mystery_memory.load()
+        if QUERY_BACKEND == 'process':
+            logger.warning("MYSTERY_DB_MODE=memory has no effect on QUERY_BACKEND=process; sandbox processes read database.db")
+
+# --- Static Assets ---
+class StaticAssets:
+    """Content hashes and precompressed variants of the files in static/.
+
+    Computed once at startup. url_for('static', ...) gains ?v=<hash>, so a
+    fingerprinted URL never changes content and is served with an immutable
+    far-future Cache-Control: browsers stop revalidating and a CDN or proxy
+    in front can answer for the workers. Text assets are served gzip- or
+    brotli-compressed from memory when the client accepts it.
+    """
+
+    COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._assets = {}
+
+    def scan(self):
+        assets = {}
+        for root, _, files in os.walk(self.folder):
+            for filename in files:
+                path = os.path.join(root, filename)
+                with open(path, 'rb') as f:
+                    content = f.read()
+                name = os.path.relpath(path, self.folder).replace(os.sep, '/')
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                variants = {}
+                if mimetype.startswith(self.COMPRESSIBLE):
+                    variants['gzip'] = gzip.compress(content, compresslevel=9, mtime=0)
+                    if brotli is not None:
+                        variants['br'] = brotli.compress(content)
+                assets[name] = {
+                    'digest': hashlib.sha256(content).hexdigest()[:12],
+                    'mimetype': mimetype,
+                    'mtime': os.path.getmtime(path),
+                    'variants': {k: v for k, v in variants.items() if len(v) < len(content)}
+                }
+        self._assets = assets
+        logger.info(f"Fingerprinted {len(assets)} static assets "
+                    f"({sum(len(a['variants']) for a in assets.values())} precompressed variants)")
+
+    def get(self, filename):
+        asset = self._assets.get(filename)
+        if asset is not None and app.debug:
+            # Pick up edits during development; deployments change files only on restart
+            path = os.path.join(self.folder, filename)
+            if not os.path.exists(path) or os.path.getmtime(path) != asset['mtime']:
+                self.scan()
+                asset = self._assets.get(filename)
+        return asset
+
+    def digest(self, filename):
+        asset = self.get(filename)
+        return asset['digest'] if asset else None
+
+
+static_assets = StaticAssets(app.static_folder)
+static_assets.scan()
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and 'v' not in values:
+        digest = static_assets.digest(values.get('filename'))
+        if digest:
+            values['v'] = digest
+
+def serve_static(filename):
+    """Flask's static view plus precompressed variants and fingerprint-aware caching"""
+    asset = static_assets.get(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+    encoding = next((e for e in ('br', 'gzip') if e in asset['variants'] and e in request.accept_encodings), None)
+    if encoding:
+        response = app.response_class(asset['variants'][encoding], mimetype=asset['mimetype'])
+        response.content_encoding = encoding
+        response.set_etag(f"{asset['digest']}-{encoding}")
+        response.make_conditional(request)
+    else:
+        response = app.send_static_file(filename)
+    if asset['variants']:
+        response.vary.add('Accept-Encoding')
+    if request.args.get('v') == asset['digest']:
+        response.cache_control.no_cache = None  # set by send_static_file's default max age
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # Unversioned or outdated URL: allow caching, but revalidate every time
+        response.cache_control.no_cache = True
+    return response
+
+app.view_functions['static'] = serve_static
+
 # --- Health Check ---
 @app.route('/health')
 def health_check():
@@ -109,6 +2016,23 @@ def add_security_headers(response):
     response.headers['Content-Security-Policy'] = "default-src 'self'; script-src 'self' 'unsafe-inline'; style-src 'self' 'unsafe-inline'; img-src 'self' data:;"
     return response
 
+# --- Request Metrics ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_time = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method)
+        metrics.observe('db_time_seconds', g.get('db_time', 0.0), route=route)
+        metrics.incr('http_requests', route=route, method=request.method, status=response.status_code)
+    return response
+
 # --- Routes ---
 @app.route('/')
 def index():
@@ -129,6 +2053,7 @@ def login():
         session.permanent = False
         session['user'] = name
         session['is_admin'] = True
+        event_log.record('login', name, admin=True)
         logger.info(f"Admin logged in: {name}")
         return 'ADMIN', 200
         
@@ -144,9 +2069,11 @@ def login():
     if not user:
         # Auto-register new user
         try:
-            db.execute('INSERT INTO participants (name, password, round_start_time) VALUES (?, ?, ?)', 
-                       (name, password, datetime.datetime.now()))
+            now = datetime.datetime.now()
+            db.execute('INSERT INTO participants (name, password, round_start_time, round_deadline) VALUES (?, ?, ?, ?)', 
+                       (name, password, now, now.timestamp() + ROUND_LIMIT_SECONDS))
             db.commit()
+            leaderboard.add(name, now.timestamp() + ROUND_LIMIT_SECONDS, now)
             logger.info(f"New user registered: {name}")
         except sqlite3.IntegrityError:
             # Race condition check just in case
@@ -160,6 +2087,7 @@ def login():
     session.permanent = False
     session['user'] = name
     session['is_admin'] = False
+    event_log.record('login', name, new=not user)
     return 'OK', 200
 
 @app.route('/logout')
@@ -176,46 +2104,39 @@ def game():
 # Timer Sync
 @app.route('/api/state')
 def get_state():
+    """Pure read: the client counts down to the absolute deadline itself"""
     if 'user' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
     db = get_db()
     name = session['user']
-    user = db.execute('SELECT * FROM participants WHERE name = ?', (name,)).fetchone()
+    user = db.execute('''
+        SELECT name, current_round, elapsed_time, round_start_time, round_deadline FROM participants WHERE name = ?
+    ''', (name,)).fetchone()
     
     if not user:
         session.pop('user', None)
         return jsonify({'error': 'User not found'}), 404
 
-    # Calculate remaining time (Example: 60 minutes limit)
-    ROUND_LIMIT_SECONDS = 3600 
-    
-    try:
-        ts_str = user['round_start_time']
-        # Try multiple formats for sqlite DATETIME
-        for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
-            try:
-                start_time = datetime.datetime.strptime(ts_str.split('+')[0], fmt)
-                break
-            except ValueError:
-                continue
-        else:
-            raise ValueError(f"Unknown date format: {ts_str}")
-            
-        elapsed_now = (datetime.datetime.now() - start_time).total_seconds()
-    except Exception as e:
-        logger.error(f"Timer calculation error for {name}: {e}")
-        elapsed_now = user['elapsed_time'] or 0
-    
-    # Update elapsed time
-    db.execute('UPDATE participants SET elapsed_time = ? WHERE name = ?', (int(elapsed_now), name))
-    db.commit()
+    deadline = participant_deadline(user)
 
-    return jsonify({
-        'name': user['name'],
-        'round': user['current_round'],
-        'remaining_time': max(0, ROUND_LIMIT_SECONDS - elapsed_now)
-    })
+    # The ETag covers everything a synced client needs; server_time and
+    # remaining_time are only used to correct the client's clock
+    etag = hashlib.sha1(f"{user['name']}:{user['current_round']}:{deadline}".encode('utf-8')).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        now = time.time()
+        response = jsonify({
+            'name': user['name'],
+            'round': user['current_round'],
+            'deadline': deadline,
+            'server_time': now,
+            'remaining_time': max(0, deadline - now)
+        })
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 # Investigation
 @app.route('/api/investigations')
@@ -225,78 +2146,86 @@ def get_investigations():
     
     db = get_db()
     name = session['user']
-    user = db.execute('SELECT * FROM participants WHERE name = ?', (name,)).fetchone()
+    # Current round and solved investigations in one statement; prompts come from the catalog
+    rows = db.execute('''
+        SELECT p.current_round, ip.investigation_id FROM participants p
+        LEFT JOIN investigation_progress ip ON ip.name = p.name AND ip.solved = 1
+        WHERE p.name = ?
+    ''', (name,)).fetchall()
     
-    if not user:
+    if not rows:
         return jsonify({'error': 'User not found'}), 404
         
-    current_round = user['current_round']
-    
-    investigations = db.execute('SELECT id, prompt, round FROM investigations WHERE round = ?', (current_round,)).fetchall()
-    
-    # Check solved status
-    progress = db.execute('SELECT investigation_id, solved FROM investigation_progress WHERE name = ?', (name,)).fetchall()
-    solved_map = {p['investigation_id']: p['solved'] for p in progress}
+    current_round = rows[0]['current_round']
+    solved = {row['investigation_id'] for row in rows}
     
     result = []
-    for inv in investigations:
+    for inv in investigation_catalog.in_round(current_round):
         result.append({
             'id': inv['id'],
             'prompt': inv['prompt'],
-            'solved': bool(solved_map.get(inv['id'], 0))
+            'solved': inv['id'] in solved
         })
     return jsonify(result)
 
 @app.route('/api/verify', methods=['POST'])
 def verify_answer():
+    """Check an answer against the catalog.
+
+    A wrong answer costs no database work. A correct one inserts the
+    progress row and, when it was new, advances the player with a single
+    conditional UPDATE that re-checks round completion inside SQLite.
+    """
     if 'user' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
     data = request.json
-    inv_id = data.get('id')
-    answer = data.get('answer', '').strip()
-    
-    db = get_db()
-    inv = db.execute('SELECT * FROM investigations WHERE id = ?', (inv_id,)).fetchone()
+    inv = investigation_catalog.get(data.get('id'))
     
     if not inv:
         return jsonify({'error': 'Invalid ID'}), 400
         
-    is_correct = inv['correct_answer'].lower() == answer.lower()
+    name = session['user']
+    if normalize_answer(data.get('answer', '')) != inv['answer']:
+        event_log.record('verify', name, investigation=inv['id'], round=inv['round'], correct=False)
+        return jsonify({'correct': False})
     
-    if is_correct:
-        # Try to insert with solved_at, fall back to without if column doesn't exist
-        try:
-            db.execute('INSERT OR IGNORE INTO investigation_progress (name, investigation_id, solved, solved_at) VALUES (?, ?, 1, ?)', 
-                       (session['user'], inv_id, datetime.datetime.now()))
-        except Exception:
-            # Fallback for legacy database without solved_at column
-            db.execute('INSERT OR IGNORE INTO investigation_progress (name, investigation_id, solved) VALUES (?, ?, 1)', 
-                       (session['user'], inv_id))
-        
-        # Check round progress
-        name = session['user']
-        user = db.execute('SELECT * FROM participants WHERE name = ?', (name,)).fetchone()
-        
-        if not user:
-            db.commit()
-            return jsonify({'correct': True, 'error': 'User not found'}), 200
-            
-        current_round = user['current_round']
-        
-        total_in_round = db.execute('SELECT COUNT(*) FROM investigations WHERE round = ?', (current_round,)).fetchone()[0]
-        solved_in_round = db.execute('''
-            SELECT COUNT(*) FROM investigation_progress p 
-            JOIN investigations i ON p.investigation_id = i.id 
-            WHERE p.name = ? AND i.round = ? AND p.solved = 1
-        ''', (name, current_round)).fetchone()[0]
-        
-        if solved_in_round >= total_in_round and current_round < 2:
-            db.execute('UPDATE participants SET current_round = current_round + 1 WHERE name = ?', (name,))
-            
-        db.commit()
+
+    solved_at = datetime.datetime.now()
+    db = get_db()
+    try:
+        inserted = db.execute('INSERT OR IGNORE INTO investigation_progress (name, investigation_id, solved, solved_at) VALUES (?, ?, 1, ?)',
+                              (name, inv['id'], solved_at)).rowcount
+    except sqlite3.OperationalError:
+        # Fallback for legacy database without solved_at column
+        inserted = db.execute('INSERT OR IGNORE INTO investigation_progress (name, investigation_id, solved) VALUES (?, ?, 1)',
+                              (name, inv['id'])).rowcount
+    
+    advanced = False
+    round_ids = [i['id'] for i in investigation_catalog.in_round(inv['round'])]
+    if inserted and inv['round'] < investigation_catalog.last_round:
+        # Advance only if the player is still in this round and has now solved all of it
+        placeholders = ', '.join('?' * len(round_ids))
+        now = solved_at.timestamp()
+        advanced = db.execute(f'''
+            UPDATE participants
+            SET current_round = current_round + 1,
+                elapsed_time = COALESCE(CAST(MIN(MAX(0, ? - ({_DEADLINE_SQL} - ?)), ?) AS INTEGER), elapsed_time, 0)
+            WHERE name = ? AND current_round = ?
+              AND (SELECT COUNT(*) FROM investigation_progress
+                   WHERE name = ? AND solved = 1 AND investigation_id IN ({placeholders})) >= ?
+        ''', (now, ROUND_LIMIT_SECONDS, ROUND_LIMIT_SECONDS, name, inv['round'], name, *round_ids,
+              len(round_ids))).rowcount > 0
+    db.commit()
+    
+    event_log.record('verify', name, investigation=inv['id'], round=inv['round'], correct=True, first=bool(inserted))
+    if inserted:
+        leaderboard.update(name, **{f"round{inv['round']}_time": format_datetime(str(solved_at))})
+    if advanced:
+        event_log.record('advance', name, round=inv['round'] + 1)
+        leaderboard.update(name, round=inv['round'] + 1)
     
-    return jsonify({'correct': is_correct})
+    return jsonify({'correct': True})
 
 @app.route('/submit', methods=['POST'])
 def submit():
@@ -327,18 +2256,24 @@ def submit():
     is_correct = (final_answer.lower() == 'miranda priestly')
     
     submission_time = datetime.datetime.now()
-    time_taken = user['elapsed_time'] # Approximate, simpler than recalculating exactly right now
+    time_taken = elapsed_seconds(user, now=submission_time.timestamp())
     
     db.execute('''
         INSERT INTO submissions (name, round, final_answer, submission_time, time_taken)
         VALUES (?, ?, ?, ?, ?)
     ''', (name, user['current_round'], final_answer, submission_time, time_taken))
     
-    # Update solved status if correct? Or just use submissions table.
-    if is_correct:
-        db.execute('UPDATE participants SET solved = 1 WHERE name = ?', (name,))
+    # Freeze the clock; solved status if correct
+    db.execute('UPDATE participants SET elapsed_time = ?, solved = ? WHERE name = ?',
+               (time_taken, 1 if is_correct else user['solved'], name))
         
     db.commit()
+    leaderboard.update(name, submitted=True, elapsed_time=time_taken,
+                       solved=bool(is_correct or user['solved']),
+                       submission={'answer': final_answer, 'correct': bool(is_correct or user['solved']),
+                                   'time': str(submission_time), 'round': user['current_round']})
+    event_log.record('submit', name, answer=final_answer, correct=is_correct, round=user['current_round'],
+                     time_taken=time_taken)
         
     return render_template('submit.html', success=is_correct, time_taken=format_time(time_taken))
 
@@ -348,62 +2283,292 @@ def execute_query():
     if 'user' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
+    retry_after = query_admission.take_token(session['user'])
+    if retry_after:
+        return rate_limited_response(retry_after, 'Too many queries.')
+
+    # Continuation of an earlier result: the signed token carries SQL that already passed the checks below
+    token = request.json.get('token')
+    # 'columnar' answers with columns plus rows as arrays instead of one object per row
+    columnar = request.json.get('format') == 'columnar'
+    if token:
+        try:
+            if not isinstance(token, str):
+                raise BadSignature('Page token must be a string')
+            page = page_tokens.loads(token)
+        except BadSignature:
+            return jsonify({'error': 'Invalid continuation token.', 'results': []}), 400
+        return run_query_page(page['sql'], page['offset'], page['columns'], columnar)
+
     sql = request.json.get('sql', '').strip()
-    
-    # Security check: Read-only enforcement
-    # Strengthened regex to catch more edge cases
-    sql_clean = sql.strip().upper()
-    
-    if not sql_clean.startswith('SELECT'):
-         return jsonify({'error': 'Only SELECT queries are allowed.', 'results': []})
-         
-    forbidden = ['INSERT', 'UPDATE', 'DELETE', 'DROP', 'ALTER', 'PRAGMA', 'ATTACH', 'TRANSACTION', 'REPLACE', 'CREATE']
-    for word in forbidden:
-        if re.search(r'\b' + word + r'\b', sql_clean):
-            logger.warning(f"Forbidden command '{word}' attempted by user: {session.get('user')}")
-            return jsonify({'error': f'Command {word} is forbidden.', 'results': []})
+    error = check_player_sql(sql)
+    if error:
+        return jsonify({'error': error, 'results': []})
+
+    # Increment query count (written behind in batches)
+    counter_buffer.add(session['user'], 'query_count')
+    leaderboard.increment(session['user'], 'queries')
+
+    return run_query_page(sql, columnar=columnar)
+
+# Leading whitespace and comments, then SELECT or WITH as a whole word
+_PLAYER_SQL_START = re.compile(r'(?:\s|--[^\n]*|/\*.*?\*/)*(?:SELECT|WITH)\b', re.I | re.S)
 
+def check_player_sql(sql):
+    """Message for SQL rejected before execution, or None.
+
+    Read-only enforcement happens in SQLite (player_authorizer); these
+    cheap checks only give clearer messages for obvious non-queries.
+    """
+    if not _PLAYER_SQL_START.match(sql or ''):
+        return 'Only SELECT queries are allowed.'
+    if not is_single_statement(sql):
+        logger.warning(f"Multiple statements attempted by user: {session.get('user')}")
+        return 'Multiple statements are forbidden.'
+    return None
+
+def run_query_page(sql, offset=0, columns=None, columnar=False):
+    """Execute one page of player SQL within the query budget"""
     try:
-        db = get_db()
-        # Increment query count
-        db.execute('UPDATE participants SET query_count = query_count + 1 WHERE name = ?', (session['user'],))
-        db.commit()
-
-        # Set a timeout for long-running queries if possible (sqlite3 connection timeout is for locks)
-        cursor = db.execute(sql)
-        columns = [description[0] for description in cursor.description]
-        rows = cursor.fetchall()
-        results = [dict(zip(columns, row)) for row in rows]
-        return jsonify({'results': results[:50], 'columns': columns}) # Limit results
+        cache_key = ResultCache.make_key(dataset_version.get(), sql, offset, QUERY_PAGE_SIZE)
+        cacheable = is_deterministic_sql(sql)
+        cached = result_cache.get(cache_key) if cacheable else None
+        if cached is not None:
+            columns, rows, next_token = cached['columns'], cached['rows'], cached['next_token']
+            query_stats.record(sql, session.get('user'), rows=len(rows), cached=True)
+            log_query_event(session.get('user'), sql, 0, len(rows), 'cached', offset=offset)
+        else:
+            user = session.get('user')
+            retry_after, reason = query_admission.acquire(user)
+            if retry_after:
+                return rate_limited_response(retry_after, QueryAdmission.REFUSALS[reason])
+            try:
+                metrics.incr('queries_executed')
+                started = time.perf_counter()
+                result = execute_player_sql(sql, offset, columns)
+                elapsed = time.perf_counter() - started
+            finally:
+                # Hand the connection back with the slot, so the next admitted query never waits on the pool
+                release_query_db()
+                query_admission.release(user)
+            if result.get('busy'):
+                metrics.incr('query_rejections', reason='sandbox_busy')
+                return rate_limited_response(1, QueryAdmission.REFUSALS['sandbox_busy'])
+            if result.get('exceeded'):
+                query_stats.record(sql, user, elapsed, result['steps'], outcome=f"budget_{result['exceeded']}")
+                log_query_event(user, sql, elapsed, outcome=f"budget_{result['exceeded']}", offset=offset)
+                logger.warning(f"Query budget ({result['exceeded']}) exceeded by user: {user}")
+                return jsonify(budget_exceeded_response(result['exceeded']))
+            if result.get('denied'):
+                logger.warning(f"{result['denied']} Attempted by user: {user}")
+                metrics.incr('queries_denied')
+                log_query_event(user, sql, elapsed, outcome='denied', offset=offset)
+                return jsonify({'error': result['denied'], 'results': []})
+            if result.get('error'):
+                log_query_event(user, sql, elapsed, outcome='error', offset=offset)
+                return jsonify({'error': result['error'], 'results': []})
+            columns, rows = result['columns'], result['rows']
+            next_token = next_page_token(sql, offset + len(rows), columns) if result['has_more'] else None
+            query_stats.record(sql, user, elapsed, result['steps'], len(rows))
+            log_query_event(user, sql, elapsed, len(rows), offset=offset)
+            if cacheable:
+                result_cache.put(cache_key, {'columns': columns, 'rows': rows, 'next_token': next_token})
+        metrics.observe('query_rows', len(rows), buckets=Counters.ROW_BUCKETS)
+        page = {
+            'columns': columns,
+            'offset': offset,
+            'has_more': next_token is not None,
+            'next_token': next_token
+        }
+        if columnar:
+            page['rows'] = rows
+            return columnar_response(page)
+        page['results'] = [dict(zip(columns, row)) for row in rows]
+        return jsonify(page)
     except Exception as e:
         return jsonify({'error': str(e), 'results': []})
 
 
+# --- Result Export ---
+class ExportStopped(Exception):
+    """Player SQL failed or ran out of budget while being exported"""
+
+def _export_batches(sql):
+    """(columns, rows) batches of one cursor over player SQL under a single EXPORT_TIMEOUT_MS budget.
+
+    The cursor lives on a pooled connection, or in one sandbox process with
+    QUERY_BACKEND=process. The budget runs only while SQLite steps it, not
+    while a chunk is on its way to the client, so a slow download is not
+    cut short.
+    """
+    job = {
+        'sql': sql, 'batch_rows': EXPORT_BATCH_ROWS, 'timeout_ms': EXPORT_TIMEOUT_MS,
+        'max_steps': QUERY_MAX_STEPS, 'progress_interval': QUERY_PROGRESS_INTERVAL
+    }
+    conn = None
+    if QUERY_BACKEND == 'process':
+        results = process_sandbox.stream(job, timeout=EXPORT_TIMEOUT_MS / 1000 + SANDBOX_GRACE_SECONDS)
+    else:
+        conn = query_pool.acquire()
+        results = stream_rows(conn, **job)
+    try:
+        for result in results:
+            if result.get('busy'):
+                metrics.incr('query_rejections', reason='sandbox_busy')
+                raise ExportStopped(f"{QueryAdmission.REFUSALS['sandbox_busy']} Try again in a moment.")
+            if result.get('exceeded'):
+                limit = result['exceeded']
+                metrics.incr('query_budget_exceeded')
+                metrics.incr(f'query_budget_exceeded_{limit}')
+                budget = (f'{SANDBOX_MEMORY_MB} MB of memory' if limit == 'memory'
+                          else f'{EXPORT_TIMEOUT_MS} ms / {QUERY_MAX_STEPS} instructions')
+                raise ExportStopped(f'Export exceeded budget ({budget}).')
+            if result.get('denied') or result.get('error'):
+                raise ExportStopped(result.get('denied') or result['error'])
+            yield result['columns'], result['rows']
+    finally:
+        results.close()
+        if conn is not None:
+            query_pool.release(conn)
+
+def _format_csv(columns, rows, header):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header and columns:
+        writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+def _format_ndjson(columns, rows, header):
+    return ''.join(json.dumps(dict(zip(columns, row)), default=str) + '\n' for row in rows)
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', _format_csv),
+    'ndjson': ('application/x-ndjson', _format_ndjson)
+}
+
+@app.route('/api/export', methods=['POST'])
+def export_query():
+    """Stream the full result of player SQL as CSV or NDJSON.
+
+    Rows go from the cursor to the client in EXPORT_BATCH_ROWS chunks, so
+    memory stays bounded whatever the result size. Errors found before the
+    first chunk get the usual JSON reply; later ones, and reaching
+    EXPORT_MAX_ROWS, end the download with a final marker line. A client
+    that leaves a chunk unread for EXPORT_STALL_SECONDS loses its cursor,
+    connection and execution slot, and the download ends there.
+    """
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    user = session['user']
+    params = request.get_json(silent=True) or request.form
+    sql = (params.get('sql') or '').strip()
+    export_format = params.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown export format, use one of {', '.join(EXPORT_FORMATS)}.", 'results': []}), 400
+    error = check_player_sql(sql)
+    if error:
+        return jsonify({'error': error, 'results': []})
+
+    retry_after = query_admission.take_token(user)
+    if retry_after:
+        return rate_limited_response(retry_after, 'Too many queries.')
+    retry_after, reason = query_admission.acquire(user)
+    if retry_after:
+        return rate_limited_response(retry_after, QueryAdmission.REFUSALS[reason])
+    counter_buffer.add(user, 'query_count')
+    leaderboard.increment(user, 'queries')
+    metrics.incr('query_exports', format=export_format)
+
+    batches = _export_batches(sql)
+    started = time.perf_counter()
+    try:
+        first = next(batches, None)
+    except ExportStopped as e:
+        query_admission.release(user)
+        log_query_event(user, sql, time.perf_counter() - started, outcome='error', export=export_format)
+        return jsonify({'error': str(e), 'results': []})
+    except Exception:
+        query_admission.release(user)
+        raise
+    mimetype, format_rows = EXPORT_FORMATS[export_format]
+    release_lock = threading.Lock()
+    released = stalled = False
+
+    def release(stall=False):
+        # Runs once: when generate() ends, or from the stall timer while a chunk sits unread
+        nonlocal released, stalled
+        with release_lock:
+            if released:
+                return
+            released, stalled = True, stall
+            batches.close()
+            query_admission.release(user)
+        if stall:
+            metrics.incr('export_stalls')
+            logger.warning(f"Export by {user} stalled for {EXPORT_STALL_SECONDS}s, released its connection")
+
+    def generate():
+        exported, outcome, marker = 0, 'ok', None
+        chunks = itertools.chain([first], batches) if first is not None else iter(())
+        try:
+            for index in itertools.count():
+                with release_lock:
+                    chunk = None if released else next(chunks, None)
+                if chunk is None:
+                    break
+                columns, rows = chunk
+                rows = rows[:EXPORT_MAX_ROWS - exported]
+                exported += len(rows)
+                # The server resumes us only once the chunk is written, so a timer that fires means the client stalled
+                timer = threading.Timer(EXPORT_STALL_SECONDS, release, (True,))
+                timer.daemon = True
+                timer.start()
+                try:
+                    yield format_rows(columns, rows, index == 0)
+                finally:
+                    timer.cancel()
+                if exported >= EXPORT_MAX_ROWS:
+                    outcome, marker = 'truncated', f'Export stopped at EXPORT_MAX_ROWS ({EXPORT_MAX_ROWS}) rows.'
+                    break
+        except ExportStopped as e:
+            outcome, marker = 'error', str(e)
+        finally:
+            release()
+            if stalled:
+                outcome, marker = 'stalled', f'Export stopped: no chunk read for EXPORT_STALL_SECONDS ({EXPORT_STALL_SECONDS}s).'
+            log_query_event(user, sql, time.perf_counter() - started, exported, outcome, export=export_format)
+            metrics.observe('query_rows', exported, buckets=Counters.ROW_BUCKETS)
+            logger.info(f"Export by {user}: {exported} rows as {export_format}")
+        if marker:
+            yield _export_marker(export_format, marker)
+
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="query.{export_format}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'  # let proxies pass chunks through as they come
+    return response
+
+def _export_marker(export_format, message):
+    """Last line of an export that did not run to completion"""
+    if export_format == 'ndjson':
+        return json.dumps({'error': message}) + '\n'
+    return f'# {message}\n'
+
 @app.route('/api/schema', methods=['GET'])
 def get_schema():
+    """Precomputed schema catalog; revalidation costs no database work"""
     if 'user' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get all tables
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")
-    tables = [row[0] for row in c.fetchall()]
-    print(f"DEBUG: Found tables in {DB_PATH}: {tables}")
-    
-    schema = {}
-    hidden_tables = ['participants', 'investigations', 'investigation_progress', 'submissions']
-    
-    for table in tables:
-        if table in hidden_tables:
-            continue
-            
-        c.execute(f"PRAGMA table_info({table})")
-        columns = [row[1] for row in c.fetchall()]
-        schema[table] = columns
-        
-    return jsonify(schema)
+    body, etag = schema_catalog.get()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={SCHEMA_CACHE_MAX_AGE}'
+    return response
 
 # --- Admin Routes ---
 def admin_required(f):
@@ -421,164 +2586,181 @@ def admin_required(f):
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
-    db = get_db()
-    
-    # Get all participants
-    participants = db.execute('''
-        SELECT name, current_round, elapsed_time, solved, query_count, round_start_time
-        FROM participants 
-        ORDER BY solved DESC, current_round DESC, elapsed_time ASC
-    ''').fetchall()
-    
-    # Get investigations
-    investigations = db.execute('SELECT * FROM investigations ORDER BY round, id').fetchall()
-    
-    # Get submissions
-    submissions = db.execute('''
-        SELECT s.*, p.solved as is_correct
-        FROM submissions s
-        JOIN participants p ON s.name = p.name
-        ORDER BY s.submission_time DESC
-    ''').fetchall()
-    
-    # Get round solve times for all participants (graceful fallback if column doesn't exist)
-    solve_times = {}
-    try:
-        round_times = db.execute('''
-            SELECT ip.name, i.round, ip.solved_at
-            FROM investigation_progress ip
-            JOIN investigations i ON ip.investigation_id = i.id
-            WHERE ip.solved = 1
-        ''').fetchall()
-        
-        # Build a map of participant -> round -> solve time
-        for rt in round_times:
-            if rt['name'] not in solve_times:
-                solve_times[rt['name']] = {}
-            solve_times[rt['name']][rt['round']] = rt['solved_at']
-    except Exception as e:
-        # Column doesn't exist in legacy database - just use empty solve times
-        logger.warning(f"Could not fetch solve times (run init_db.py to add solved_at column): {e}")
-    
-    stats = []
-    for p in participants:
-        name = p['name']
-        participant_solves = solve_times.get(name, {})
-        stats.append({
-            'name': name,
-            'round': p['current_round'],
-            'time': format_time(p['elapsed_time']),
-            'solved': p['solved'],
-            'queries': p['query_count'],
-            'round1_time': format_datetime(participant_solves.get(1)),
-            'round2_time': format_datetime(participant_solves.get(2)),
-            'start_time': p['round_start_time']
-        })
+    snapshot = leaderboard.snapshot()
     
     inv_list = []
-    for inv in investigations:
+    for inv in investigation_catalog.all():
         inv_list.append({
             'id': inv['id'],
             'round': inv['round'],
             'prompt': inv['prompt'],
             'answer': inv['correct_answer']
         })
-    
-    sub_list = []
-    for sub in submissions:
-        sub_list.append({
-            'name': sub['name'],
-            'round': sub['round'],
-            'answer': sub['final_answer'],
-            'time': sub['submission_time'],
-            'correct': sub['is_correct']
-        })
         
     return render_template('admin.html', 
-                           stats=stats, 
+                           stats=snapshot['stats'], 
                            investigations=inv_list,
-                           submissions=sub_list,
+                           submissions=snapshot['submissions'],
                            admin_user=session['user'])
 
 @app.route('/api/admin/stats')
 @admin_required
 def admin_stats_api():
-    """API endpoint for live admin dashboard updates"""
-    db = get_db()
-    
-    # Get all participants
-    participants = db.execute('''
-        SELECT name, current_round, elapsed_time, solved, query_count, round_start_time
-        FROM participants 
-        ORDER BY solved DESC, current_round DESC, elapsed_time ASC
-    ''').fetchall()
-    
-    # Get submissions
-    submissions = db.execute('''
-        SELECT s.*, p.solved as is_correct
-        FROM submissions s
-        JOIN participants p ON s.name = p.name
-        ORDER BY s.submission_time DESC
-    ''').fetchall()
-    
-    # Get round solve times for all participants (graceful fallback if column doesn't exist)
-    solve_times = {}
-    try:
-        round_times = db.execute('''
-            SELECT ip.name, i.round, ip.solved_at
-            FROM investigation_progress ip
-            JOIN investigations i ON ip.investigation_id = i.id
-            WHERE ip.solved = 1
-        ''').fetchall()
-        
-        # Build a map of participant -> round -> solve time
-        for rt in round_times:
-            if rt['name'] not in solve_times:
-                solve_times[rt['name']] = {}
-            solve_times[rt['name']][rt['round']] = rt['solved_at']
-    except Exception as e:
-        # Column doesn't exist in legacy database
-        logger.warning(f"Could not fetch solve times: {e}")
-    
-    stats = []
-    for p in participants:
-        name = p['name']
-        participant_solves = solve_times.get(name, {})
-        stats.append({
-            'name': name,
-            'round': p['current_round'],
-            'time': format_time(p['elapsed_time']),
-            'solved': bool(p['solved']),
-            'queries': p['query_count'],
-            'round1_time': format_datetime(participant_solves.get(1)),
-            'round2_time': format_datetime(participant_solves.get(2))
-        })
-    
-    sub_list = []
-    for sub in submissions:
-        sub_list.append({
-            'name': sub['name'],
-            'answer': sub['final_answer'],
-            'correct': bool(sub['is_correct'])
-        })
-    
+    """API endpoint for live admin dashboard updates.
+
+    Served from the in-memory leaderboard. Pass ?since=<version>&epoch=<epoch>
+    from the previous response to receive only the rows changed since then.
+    """
+    since = request.args.get('since', type=int)
+    return jsonify(leaderboard.changes_since(since, request.args.get('epoch')))
+
+@app.route('/api/admin/events')
+@admin_required
+def admin_events():
+    """Server-Sent Events stream of leaderboard deltas for the admin dashboard.
+
+    Sends a full snapshot first (or a delta when reconnecting: from the
+    Last-Event-ID header EventSource sends, else from since/epoch), then one
+    coalesced 'leaderboard' event per burst of changes and a comment
+    heartbeat when idle. The stream ends after SSE_MAX_DURATION so a worker
+    thread is never pinned for good; EventSource reconnects by itself.
+    """
+    if not ADMIN_SSE_ENABLED:
+        return jsonify({'error': 'Live updates disabled'}), 404
+    since = request.args.get('since', type=int)
+    epoch = request.args.get('epoch')
+    # On reconnect EventSource reuses the original URL; the last event id it saw is the real position
+    last_epoch, _, last_version = request.headers.get('Last-Event-ID', '').rpartition(':')
+    if last_epoch and last_version.isdigit():
+        since, epoch = int(last_version), last_epoch
+
+    def stream(since, epoch):
+        ends_at = time.monotonic() + SSE_MAX_DURATION
+        last_sent = 0.0
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < ends_at:
+            data = leaderboard.changes_since(since, epoch)
+            if data['full'] or data['stats'] or data['removed'] or 'submissions' in data:
+                yield f"id: {data['epoch']}:{data['version']}\nevent: leaderboard\ndata: {json.dumps(data)}\n\n"
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                yield ': heartbeat\n\n'
+                last_sent = time.monotonic()
+            since, epoch = data['version'], data['epoch']
+            # Wake on a local change, or periodically to pick up other workers' writes
+            if leaderboard.wait_for_change(since, min(SSE_HEARTBEAT_SECONDS, LEADERBOARD_RESYNC_INTERVAL)):
+                time.sleep(SSE_COALESCE_SECONDS)
+
+    return Response(stream(since, epoch), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/admin/metrics')
+@admin_required
+def admin_metrics_api():
+    """Counters for this worker process (budget hits, queries executed)"""
     return jsonify({
-        'stats': stats,
-        'submissions': sub_list
+        'counters': metrics.snapshot(),
+        'query_cache': result_cache.stats(),
+        'admission': query_admission.stats(),
+        'query_backend': QUERY_BACKEND,
+        'sandbox': process_sandbox.stats(),
+        'mystery_db': dict(mystery_memory.stats(), mode=MYSTERY_DB_MODE),
+        'memory': process_memory(),
+        'storage': storage_settings,
+        'query_budget': {'timeout_ms': QUERY_TIMEOUT_MS, 'max_instructions': QUERY_MAX_STEPS}
     })
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint for this worker process.
+
+    Open to an admin session, or to `Authorization: Bearer <METRICS_TOKEN>`.
+    Every series carries a `worker` label; sum across workers in queries.
+    """
+    authorization = request.headers.get('Authorization', '').encode('utf-8')
+    token_ok = bool(METRICS_TOKEN) and hmac.compare_digest(authorization, f'Bearer {METRICS_TOKEN}'.encode('utf-8'))
+    if not (token_ok or session.get('is_admin')):
+        return 'Forbidden', 403
+
+    cache = result_cache.stats()
+    pool = query_pool.stats()
+    admission = query_admission.stats()
+    sandbox = process_sandbox.stats()
+    memory = process_memory()
+    body = metrics.prometheus(
+        'query_clash_',
+        counters=[
+            ('query_cache_lookups', cache['hits'], {'result': 'hit'}),
+            ('query_cache_lookups', cache['shared_hits'], {'result': 'shared_hit'}),
+            ('query_cache_lookups', cache['misses'], {'result': 'miss'}),
+        ] + [('sandbox_processes_replaced', count, {'reason': reason}) for reason, count in sandbox['replaced'].items()],
+        gauges=[
+            ('query_cache_entries', cache['entries'], {}),
+            ('query_cache_bytes', cache['bytes'], {}),
+            ('query_pool_connections', pool['connections'], {}),
+            ('query_pool_idle_connections', pool['idle'], {}),
+            ('query_executions_running', admission['running'], {}),
+            ('query_queue_depth', admission['queued'], {}),
+            ('sandbox_processes', sandbox['processes'], {}),
+            ('pending_counter_increments', counter_buffer.pending_total(), {}),
+            ('pending_events', event_log.pending_total(), {}),
+            ('leaderboard_participants', len(leaderboard), {}),
+            ('mystery_db_memory_bytes', mystery_memory.info.get('bytes', 0), {}),
+        ] + [('process_memory_bytes', value, {'kind': kind}) for kind, value in memory.items()],
+        worker=os.getpid())
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/index-advisor')
+@admin_required
+def admin_index_advisor_api():
+    """Missing mystery-table indexes ranked by the full scans they would remove.
+
+    Based on the player queries sampled by this worker process; add the
+    suggested statements to MYSTERY_INDEXES in init_db.py before an event.
+    """
+    return jsonify(index_advisor.report(query_stats.snapshot()))
+
+@app.route('/api/admin/queries')
+@admin_required
+def admin_queries_api():
+    """Player query shapes by total execution time, the slow-query log and admission state (this worker)"""
+    report = query_stats.report(request.args.get('limit', 25, type=int))
+    report['admission'] = query_admission.stats()
+    return jsonify(report)
+
+@app.route('/api/admin/event-log')
+@admin_required
+def admin_event_log_api():
+    """Stored contest events after ?after=<id>, oldest first, for incremental replay.
+
+    Optional ?kind= (repeatable) filters by event kind; ?limit= caps the
+    page (default 1000). Pass the last id back as ?after= for the next page.
+    """
+    event_log.flush()
+    limit = min(request.args.get('limit', 1000, type=int), 10000)
+    events = list(event_log.replay(request.args.get('after', 0, type=int), request.args.getlist('kind'), limit))
+    return jsonify({'events': events, 'last_id': events[-1]['id'] if events else request.args.get('after', 0, type=int)})
+
+@app.route('/api/admin/report')
+@admin_required
+def admin_report_api():
+    """Post-contest report replayed from the event log alone, never the live tables"""
+    event_log.flush()
+    return jsonify(contest_report(event_log.replay(by_time=True)))
+
 @app.route('/admin/reset-user/<name>', methods=['POST'])
 @admin_required
 def reset_user(name):
     db = get_db()
+    now = datetime.datetime.now()
     
     # Reset user's progress
     db.execute('''
         UPDATE participants 
         SET current_round = 1, elapsed_time = 0, solved = 0, query_count = 0,
-            round_start_time = ?
+            round_start_time = ?, round_deadline = ?
         WHERE name = ?
-    ''', (datetime.datetime.now(), name))
+    ''', (now, now.timestamp() + ROUND_LIMIT_SECONDS, name))
     
     # Clear their investigation progress
     db.execute('DELETE FROM investigation_progress WHERE name = ?', (name,))
@@ -587,6 +2769,10 @@ def reset_user(name):
     db.execute('DELETE FROM submissions WHERE name = ?', (name,))
     
     db.commit()
+    counter_buffer.discard(name)
+    leaderboard.update(name, round=1, solved=False, queries=0, elapsed_time=0, submitted=False, submission=None,
+                       started_at=now.timestamp(), start_time=str(now), round1_time='-', round2_time='-')
+    event_log.record('admin', session['user'], action='reset_user', target=name)
     logger.info(f"Admin reset user: {name}")
     
     return jsonify({'success': True, 'message': f'User {name} has been reset'})
@@ -601,30 +2787,98 @@ def delete_user(name):
     db.execute('DELETE FROM participants WHERE name = ?', (name,))
     
     db.commit()
+    counter_buffer.discard(name)
+    leaderboard.remove(name)
+    query_admission.forget(name)
+    event_log.record('admin', session['user'], action='delete_user', target=name)
     logger.info(f"Admin deleted user: {name}")
     
     return jsonify({'success': True, 'message': f'User {name} has been deleted'})
 
+# --- Spectator Analytics ---
+class AnalyticsSnapshot:
+    """Ranked /analytics table shared by all spectator requests of a worker.
+
+    Built from the in-memory leaderboard at most once per
+    ANALYTICS_TTL_SECONDS. One request rebuilds an expired snapshot while
+    the others keep serving the previous one, and rendered pages are kept
+    with the snapshot, so a refresh costs a dict lookup or a 304.
+    """
+
+    MAX_RENDERED = 64  # distinct (top, page) views kept per snapshot
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._current = None
+        self._rebuild_lock = threading.Lock()
+
+    def get(self):
+        current = self._current
+        if current is not None and time.monotonic() - current['built_at'] < self.ttl:
+            return current
+        # Single flight: without a snapshot to fall back on, wait for the rebuild
+        if not self._rebuild_lock.acquire(blocking=current is None):
+            return current
+        try:
+            current = self._current
+            if current is None or time.monotonic() - current['built_at'] >= self.ttl:
+                current = self._current = self._build()
+            return current
+        finally:
+            self._rebuild_lock.release()
+
+    def _build(self):
+        stats = leaderboard.snapshot()['stats']
+        stats.sort(key=lambda r: (-r['queries'], r['elapsed']))
+        rows = [{
+            'rank': rank,
+            'name': r['name'],
+            'round': r['round'],
+            'time': r['time'],
+            'solved': "YES" if r['solved'] else "NO",
+            'queries': r['queries']
+        } for rank, r in enumerate(stats, 1)]
+        digest = hashlib.sha1(json.dumps(rows, separators=(',', ':')).encode('utf-8')).hexdigest()[:16]
+        metrics.incr('analytics_rebuilds')
+        return {'rows': rows, 'etag': digest, 'built_at': time.monotonic(), 'rendered': {}}
+
+    def clear(self):
+        self._current = None
+
+
+analytics_snapshot = AnalyticsSnapshot(ANALYTICS_TTL_SECONDS)
+
 @app.route('/analytics')
 def analytics():
-    db = get_db()
-    participants = db.execute('''
-        SELECT name, current_round, elapsed_time, solved, query_count 
-        FROM participants 
-        ORDER BY query_count DESC, elapsed_time ASC
-    ''').fetchall()
-    
-    stats = []
-    for p in participants:
-        stats.append({
-            'name': p['name'],
-            'round': p['current_round'],
-            'time': format_time(p['elapsed_time']),
-            'solved': "YES" if p['solved'] else "NO",
-            'queries': p['query_count']
-        })
-        
-    return render_template('analytics.html', stats=stats)
+    """Public leaderboard for spectators and the big screen.
+
+    ?top=N limits the table to the first N operators; ?page=P pages through
+    it ANALYTICS_PAGE_SIZE rows at a time. Supports If-None-Match.
+    """
+    snapshot = analytics_snapshot.get()
+    total = len(snapshot['rows'])
+    top = request.args.get('top', type=int)
+    top = min(max(top, 1), total) if top else total
+    pages = max(1, math.ceil(top / ANALYTICS_PAGE_SIZE))
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    key = (top, page)
+
+    etag = f"{snapshot['etag']}-{top}-{page}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        body = snapshot['rendered'].get(key)
+        if body is None:
+            start = (page - 1) * ANALYTICS_PAGE_SIZE
+            body = render_template('analytics.html', stats=snapshot['rows'][start:min(start + ANALYTICS_PAGE_SIZE, top)],
+                                   page=page, pages=pages, top=top if top < total else None, total=total)
+            if len(snapshot['rendered']) >= AnalyticsSnapshot.MAX_RENDERED:
+                snapshot['rendered'].clear()
+            snapshot['rendered'][key] = body
+        response = app.response_class(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={int(ANALYTICS_TTL_SECONDS)}'
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,24 +1,56 @@
 import sqlite3
 import os
 import datetime
+import time
+import argparse
 
 DB_PATH = 'database.db'
 SOURCE_DB_PATH = 'sql-murder-mystery.db'
+ROUND_LIMIT_SECONDS = int(os.environ.get('ROUND_LIMIT_SECONDS', '3600'))
 
-def init_db():
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
-    
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# Secondary indexes on the mystery tables: (table, column).
+# The join keys of the walkthrough, plus the columns players filter on most.
+# GET /api/admin/index-advisor suggests additions from the queries actually run.
+MYSTERY_INDEXES = [
+    ('person', 'license_id'),
+    ('person', 'ssn'),
+    ('person', 'name'),
+    ('person', 'address_street_name'),
+    ('interview', 'person_id'),
+    ('facebook_event_checkin', 'person_id'),
+    ('get_fit_now_member', 'person_id'),
+    ('get_fit_now_check_in', 'membership_id'),
+    ('crime_scene_report', 'date'),
+]
 
-    # Core Application Tables
+def create_mystery_indexes(c):
+    """Build MYSTERY_INDEXES for the tables present and refresh planner statistics"""
+    tables = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    for table, column in MYSTERY_INDEXES:
+        if table in tables:
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})")
+    c.execute("ANALYZE main")
+
+GAME_TABLES = ('participants', 'investigations', 'investigation_progress', 'submissions')
+# Append-only contest history: kept by --reset-game unless --clear-history is given as well
+HISTORY_TABLES = ('contest_events',)
+
+# Loading runs in a single transaction on a fresh file, so there is nothing to recover on a crash
+LOAD_PRAGMAS = (
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA temp_store = MEMORY',
+)
+
+def create_game_tables(c):
     c.execute('''
         CREATE TABLE participants (
             name TEXT PRIMARY KEY,
             password TEXT,
             current_round INTEGER DEFAULT 1,
             round_start_time DATETIME,
+            round_deadline REAL,
             elapsed_time INTEGER DEFAULT 0,
             solved INTEGER DEFAULT 0,
             query_count INTEGER DEFAULT 0
@@ -54,49 +86,131 @@ def init_db():
         )
     ''')
 
-    # Migrate Mystery Data from Source DB
-    if os.path.exists(SOURCE_DB_PATH):
+    # Append-only game history, written in batches by the app (see EventLog in app.py)
+    c.execute('''
+        CREATE TABLE contest_events (
+            id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            kind TEXT NOT NULL,
+            name TEXT,
+            data TEXT
+        )
+    ''')
+    c.execute('CREATE INDEX idx_contest_events_ts ON contest_events (ts)')
+
+def seed_game_state(c):
+    # Populate Investigations (SQL Murder Mystery Flow)
+    # Round 1: Finding the murderer
+    c.execute("INSERT INTO investigations (round, prompt, correct_answer) VALUES (1, 'Who committed the murder on Jan 15, 2018 in SQL City?', 'Jeremy Bowers')")
+    
+    # Round 2: Finding the mastermind
+    c.execute("INSERT INTO investigations (round, prompt, correct_answer) VALUES (2, 'Who hired the murderer? (Check the killer''s interview for clues)', 'Miranda Priestly')")
+
+    # Production User
+    now = datetime.datetime.now()
+    c.execute("INSERT INTO participants (name, password, round_start_time, round_deadline) VALUES (?, ?, ?, ?)", 
+              ('Query_clash', '8888', now, now.timestamp() + ROUND_LIMIT_SECONDS))
+
+def init_db():
+    started = time.perf_counter()
+    # Drop the old database along with any WAL/shared-memory files the app left behind
+    for path in (DB_PATH, DB_PATH + '-wal', DB_PATH + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    
+    # Autocommit connection: transactions are explicit so ATTACH can run outside one
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    c = conn.cursor()
+    for pragma in LOAD_PRAGMAS:
+        c.execute(pragma)
+
+    has_source = os.path.exists(SOURCE_DB_PATH)
+    if has_source:
+        c.execute("ATTACH DATABASE ? AS source", (f'file:{SOURCE_DB_PATH}?mode=ro',))
+
+    c.execute("BEGIN")
+
+    # Core Application Tables
+    create_game_tables(c)
+
+    # Migrate Mystery Data from Source DB, copied page by page inside SQLite
+    if has_source:
         print(f"Migrating data from {SOURCE_DB_PATH}...")
-        source_conn = sqlite3.connect(SOURCE_DB_PATH)
-        source_cursor = source_conn.cursor()
 
         # Get all table names from source (excluding internal ones if any)
-        source_cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name != 'solution'")
-        tables = source_cursor.fetchall()
+        tables = c.execute("SELECT name, sql FROM source.sqlite_master WHERE type='table' AND name != 'solution'").fetchall()
 
         for table_name, create_sql in tables:
             print(f"  Creating and migrating table: {table_name}")
             c.execute(create_sql)
-            
-            # Copy data
-            source_cursor.execute(f"SELECT * FROM {table_name}")
-            rows = source_cursor.fetchall()
-            if rows:
-                placeholders = ', '.join(['?' for _ in range(len(rows[0]))])
-                c.executemany(f"INSERT INTO {table_name} VALUES ({placeholders})", rows)
-        
-        source_conn.close()
+            c.execute(f'INSERT INTO main."{table_name}" SELECT * FROM source."{table_name}"')
+
+        # Indexes are built once the tables are full, which is far cheaper than maintaining them row by row
+        print(f"  Creating {len(MYSTERY_INDEXES)} secondary indexes")
+        create_mystery_indexes(c)
     else:
         print(f"Warning: Source database not found at {SOURCE_DB_PATH}. Mystery tables will be empty.")
 
-    # Populate Investigations (SQL Murder Mystery Flow)
-    # Round 1: Finding the murderer
-    c.execute("INSERT INTO investigations (round, prompt, correct_answer) VALUES (1, 'Who committed the murder on Jan 15, 2018 in SQL City?', 'Jeremy Bowers')")
+    seed_game_state(c)
     
-    # Round 2: Finding the mastermind
-    c.execute("INSERT INTO investigations (round, prompt, correct_answer) VALUES (2, 'Who hired the murderer? (Check the killer''s interview for clues)', 'Miranda Priestly')")
+    # Stamp the dataset so the app can tell a rebuilt database from game-state writes
+    c.execute(f"PRAGMA user_version = {int(datetime.datetime.now().timestamp())}")
 
-    # Production User
-    c.execute("INSERT INTO participants (name, password, round_start_time) VALUES (?, ?, ?)", 
-              ('Query_clash', '8888', datetime.datetime.now()))
-    
-    conn.commit()
+    c.execute("COMMIT")
+    if has_source:
+        c.execute("DETACH DATABASE source")
     conn.close()
-    print("Database initialized successfully with SQL Murder Mystery data.")
+    print(f"Database initialized successfully with SQL Murder Mystery data in {time.perf_counter() - started:.2f}s.")
+
+def reset_game(clear_history=False):
+    """Clear players and progress between contest sessions, keeping the mystery data.
+
+    Only the game tables are rewritten, in one transaction, so the schema and
+    the user_version stamp are unchanged: running app workers keep their
+    result caches and pick up the new game state on their next resync. The
+    contest event log is kept, with the reset appended to it, unless
+    clear_history is set.
+    """
+    if not os.path.exists(DB_PATH):
+        return init_db()
+    started = time.perf_counter()
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, timeout=10)
+    c = conn.cursor()
+    existing = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if not existing.issuperset(GAME_TABLES):
+        conn.close()
+        return init_db()
+
+    c.execute("BEGIN IMMEDIATE")
+    for table in GAME_TABLES:
+        c.execute(f"DELETE FROM {table}")
+    # Older databases get contest_events from the app on its next start
+    history = [table for table in HISTORY_TABLES if table in existing]
+    if clear_history:
+        for table in history:
+            c.execute(f"DELETE FROM {table}")
+    if 'contest_events' in history:
+        c.execute("INSERT INTO contest_events (ts, kind, data) VALUES (?, 'admin', '{\"action\":\"reset_game\"}')",
+                  (time.time(),))
+    seed_game_state(c)
+    c.execute("COMMIT")
+    conn.close()
+    kept = 'mystery data kept' if clear_history else 'mystery data and event history kept'
+    print(f"Game state reset in {time.perf_counter() - started:.3f}s ({kept}).")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the Query Clash database.')
+    parser.add_argument('--reset-game', action='store_true',
+                        help='only clear players and progress, keeping the mystery tables')
+    parser.add_argument('--clear-history', action='store_true',
+                        help='with --reset-game, also delete the contest event log')
+    args = parser.parse_args()
+
     # Adjust path if running from within query_clash directory
     if not os.path.exists(SOURCE_DB_PATH) and os.path.exists(os.path.join('sql-mysteries-master', 'sql-murder-mystery.db')):
         SOURCE_DB_PATH = os.path.join('sql-mysteries-master', 'sql-murder-mystery.db')
     
-    init_db()
+    if args.reset_game:
+        reset_game(args.clear_history)
+    else:
+        init_db()
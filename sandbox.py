@@ -0,0 +1,471 @@
+"""Execution core for player SQL, shared by the web workers and the sandbox processes.
+
+Holds the authorizer that keeps players on the mystery tables, the
+per-statement budget and the paging logic. It also holds ProcessSandbox, a
+pool of pre-started worker processes that run player statements under hard
+rlimits. Only the standard library is imported here, so a sandbox process
+starts without loading Flask or the app.
+"""
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows: limits are skipped
+    resource = None
+
+# Game-state tables players must never read, even though they share the file
+HIDDEN_TABLES = ('participants', 'investigations', 'investigation_progress', 'submissions', 'contest_events')
+# Schema tables stay readable: the murder mystery walkthrough starts from sqlite_master
+SCHEMA_TABLES = ('sqlite_master', 'sqlite_schema', 'sqlite_temp_master', 'sqlite_temp_schema')
+
+_ALLOWED_ACTIONS = (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE)
+_ACTION_NAMES = {
+    getattr(sqlite3, f'SQLITE_{name}'): name.split('_')[0]
+    for name in ('ALTER_TABLE', 'ANALYZE', 'ATTACH', 'CREATE_INDEX', 'CREATE_TABLE', 'CREATE_TEMP_INDEX',
+                 'CREATE_TEMP_TABLE', 'CREATE_TEMP_TRIGGER', 'CREATE_TEMP_VIEW', 'CREATE_TRIGGER',
+                 'CREATE_VIEW', 'CREATE_VTABLE', 'DELETE', 'DETACH', 'DROP_INDEX', 'DROP_TABLE',
+                 'DROP_TEMP_INDEX', 'DROP_TEMP_TABLE', 'DROP_TEMP_TRIGGER', 'DROP_TEMP_VIEW',
+                 'DROP_TRIGGER', 'DROP_VIEW', 'DROP_VTABLE', 'INSERT', 'PRAGMA', 'REINDEX',
+                 'SAVEPOINT', 'TRANSACTION', 'UPDATE')
+}
+
+def player_authorizer(conn):
+    """SQLite authorizer allowing only reads of the mystery tables.
+
+    Runs at prepare time, so writes, schema changes, PRAGMA, ATTACH and reads
+    of HIDDEN_TABLES fail before a single row is touched. The denial is
+    recorded on the connection so the endpoint can explain it.
+    """
+    def authorize(action, arg1, arg2, db_name, trigger):
+        if action in _ALLOWED_ACTIONS:
+            return sqlite3.SQLITE_OK
+        if action == sqlite3.SQLITE_READ:
+            table = (arg1 or '').lower()
+            if table in HIDDEN_TABLES or (table.startswith('sqlite_') and table not in SCHEMA_TABLES):
+                conn.denied = f'Access to table {arg1} is forbidden.'
+                return sqlite3.SQLITE_DENY
+            return sqlite3.SQLITE_OK
+        if action == sqlite3.SQLITE_UPDATE and (arg1 or '').lower() == 'sqlite_master':
+            # Raised by SQLite itself while it sets up a table-valued function such as json_each();
+            # player SQL cannot modify sqlite_master, and pragma_*() functions are still denied as PRAGMA
+            return sqlite3.SQLITE_OK
+        conn.denied = f"Command {_ACTION_NAMES.get(action, 'UNKNOWN')} is forbidden."
+        return sqlite3.SQLITE_DENY
+    return authorize
+
+
+class QueryBudget:
+    """Abort a statement once it exceeds its wall-clock or VM-instruction budget.
+
+    Installed as the connection's progress handler for the duration of a
+    query, including the fetch, so SQLite itself stops stepping the statement
+    and raises OperationalError('interrupted'). Entering it again resumes the
+    same budget: a cursor stepped in bursts is charged only for the time
+    spent inside SQLite.
+    """
+
+    def __init__(self, conn, timeout_ms, max_steps, progress_interval=1000):
+        self.conn = conn
+        self.timeout_ms = timeout_ms
+        self.max_steps = max_steps
+        self.progress_interval = progress_interval
+        self.steps = 0
+        self.elapsed = 0.0
+        self.exceeded = None
+
+    def _check(self):
+        self.steps += self.progress_interval
+        if self.steps > self.max_steps:
+            self.exceeded = 'instructions'
+        elif time.monotonic() > self.deadline:
+            self.exceeded = 'time'
+        return 1 if self.exceeded else 0
+
+    def __enter__(self):
+        self._entered = time.monotonic()
+        self.deadline = self._entered + self.timeout_ms / 1000 - self.elapsed
+        self.conn.set_progress_handler(self._check, self.progress_interval)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.set_progress_handler(None, 0)
+        self.elapsed += time.monotonic() - self._entered
+        return False
+
+
+def fetch_rows(conn, sql, offset, page_size, columns=None):
+    """Fetch one page of a player query without materializing the rest.
+
+    The first page steps the player's statement directly and stops after
+    page_size + 1 rows. Continuation pages push LIMIT/OFFSET into SQLite, so
+    skipped rows never reach Python; columns are carried over from the first
+    page because the subquery wrapper renames duplicate column names.
+    Returns (columns, rows, has_more).
+    """
+    if offset:
+        # The newline ends a trailing -- comment in the player's SQL before the closing paren
+        cursor = conn.execute(f'SELECT * FROM ({sql.rstrip().rstrip(";")}\n) LIMIT ? OFFSET ?',
+                              (page_size + 1, offset))
+    else:
+        cursor = conn.execute(sql)
+    if cursor.description is None:
+        return columns or [], [], False
+    columns = columns or [description[0] for description in cursor.description]
+    rows = cursor.fetchmany(page_size + 1)
+    cursor.close()
+    return columns, [tuple(row) for row in rows[:page_size]], len(rows) > page_size
+
+
+def execute_page(conn, sql, offset=0, columns=None, page_size=50, timeout_ms=2000, max_steps=50000000,
+                 progress_interval=1000):
+    """Run one page of player SQL within its budget on an authorizer-guarded connection.
+
+    Returns a plain dict, so the same result crosses a process boundary:
+    {'columns', 'rows', 'has_more', 'steps'} on success, otherwise 'steps'
+    plus one of 'exceeded' (the limit hit), 'denied' (the authorizer's
+    message) or 'error'.
+    """
+    budget = QueryBudget(conn, timeout_ms, max_steps, progress_interval)
+    conn.denied = None
+    with budget:
+        try:
+            columns, rows, has_more = fetch_rows(conn, sql, offset, page_size, columns)
+        except sqlite3.DatabaseError as e:
+            if budget.exceeded:
+                return {'exceeded': budget.exceeded, 'steps': budget.steps}
+            if conn.denied:
+                return {'denied': conn.denied, 'steps': budget.steps}
+            return {'error': str(e), 'steps': budget.steps}
+    return {'columns': columns, 'rows': rows, 'has_more': has_more, 'steps': budget.steps}
+
+
+def stream_rows(conn, sql, batch_rows=500, timeout_ms=10000, max_steps=50000000, progress_interval=1000):
+    """Step one cursor over the whole result of player SQL, batch_rows rows at a time.
+
+    Yields dicts shaped like execute_page() results, the last one with
+    has_more false (a failure is always last). The first batch comes even
+    when empty. One budget covers the whole stream, charged only while
+    SQLite steps the cursor, not while the consumer holds a batch.
+    """
+    budget = QueryBudget(conn, timeout_ms, max_steps, progress_interval)
+    conn.denied = None
+    cursor = None
+    try:
+        with budget:
+            cursor = conn.execute(sql)
+        if cursor.description is None:
+            yield {'columns': [], 'rows': [], 'has_more': False, 'steps': budget.steps}
+            return
+        columns = [description[0] for description in cursor.description]
+        while True:
+            with budget:
+                rows = cursor.fetchmany(batch_rows)
+            has_more = len(rows) == batch_rows
+            yield {'columns': columns, 'rows': [tuple(row) for row in rows], 'has_more': has_more,
+                   'steps': budget.steps}
+            if not has_more:
+                return
+    except sqlite3.DatabaseError as e:
+        if budget.exceeded:
+            yield {'exceeded': budget.exceeded, 'steps': budget.steps}
+        elif conn.denied:
+            yield {'denied': conn.denied, 'steps': budget.steps}
+        else:
+            yield {'error': str(e), 'steps': budget.steps}
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+
+# --- Process Sandbox ---
+class SandboxConnection(sqlite3.Connection):
+    denied = None  # last authorizer denial, see player_authorizer
+
+
+def _worker_main(conn, path, memory_mb, cpu_seconds, recycle_mb):
+    """Sandbox process: one read-only connection, one statement at a time, under rlimits"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # shutdown is driven by the parent
+    if resource and memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, isolation_level=None, factory=SandboxConnection)
+    db.set_authorizer(player_authorizer(db))
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        _allow_cpu(cpu_seconds)
+        try:
+            if request.pop('stream', False):
+                result = _serve_stream(conn, db, request, cpu_seconds)
+            else:
+                result = execute_page(db, **request)
+        except MemoryError:
+            result = {'exceeded': 'memory', 'steps': 0, 'recycle': True}
+        except (EOFError, OSError):
+            break
+        if resource and recycle_mb:
+            peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+            if peak_mb > recycle_mb:
+                result['recycle'] = True
+        try:
+            conn.send(result)
+        except MemoryError:
+            conn.send({'exceeded': 'memory', 'steps': result.get('steps', 0), 'recycle': True})
+            break
+        if result.get('recycle'):
+            break
+    db.close()
+
+
+def _allow_cpu(cpu_seconds):
+    if resource and cpu_seconds:
+        # RLIMIT_CPU counts the whole process lifetime: allow cpu_seconds more from now
+        used = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(used.ru_utime + used.ru_stime) + cpu_seconds
+        hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _serve_stream(conn, db, request, cpu_seconds):
+    """Send stream_rows() batches one at a time, each once the parent asks for it.
+
+    Returns the message that ends the stream: the last batch or a failure,
+    or an empty dict when the parent cancels.
+    """
+    batches = stream_rows(db, **request)
+    try:
+        while True:
+            result = next(batches)
+            if not result.get('has_more'):
+                return result
+            conn.send(result)
+            if not conn.recv():
+                return {}
+            _allow_cpu(cpu_seconds)  # cpu_seconds per batch; the stream's budget bounds the total
+    finally:
+        batches.close()
+
+
+class _Worker:
+    def __init__(self, process, conn, generation):
+        self.process = process
+        self.conn = conn
+        self.generation = generation
+
+
+class ProcessSandbox:
+    """Pool of pre-started processes executing player SQL under hard limits.
+
+    Each process holds its own read-only, authorizer-guarded connection and
+    runs under RLIMIT_AS (memory_mb) and a per-statement RLIMIT_CPU
+    (cpu_seconds), on top of the usual QueryBudget. The caller waits for a
+    result with a timeout: a process that misses it, dies, or whose peak RSS
+    passes recycle_mb is killed and replaced in the background, so a
+    pathological statement can neither bloat nor block a web worker.
+
+    Processes are started with 'spawn' (safe from threaded web workers) on
+    first use, and again after a fork or reset().
+    """
+
+    def __init__(self, path, size, memory_mb=0, cpu_seconds=0, recycle_mb=0):
+        self.path = path
+        self.size = size
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.recycle_mb = recycle_mb
+        self.generation = 0
+        self.replaced = {}  # reason -> workers killed or retired
+        self._ctx = multiprocessing.get_context('spawn')
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main, name='query-sandbox', daemon=True,
+            args=(child_conn, self.path, self.memory_mb, self.cpu_seconds, self.recycle_mb))
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn, self.generation)
+
+    def _ensure_started(self):
+        """Pre-start the pool in this process (again after a fork, whose inherited pipes are unusable)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._idle = queue.LifoQueue()
+            self._created = self.size
+            self._pid = os.getpid()
+        for _ in range(self.size):
+            self._idle.put(self._start())
+
+    def _replenish(self):
+        with self._lock:
+            if self._created >= self.size:
+                return
+            self._created += 1
+        try:
+            self._idle.put(self._start())
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _retire(self, worker, reason):
+        """Kill a worker and start its replacement off the request path"""
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join(timeout=1)
+        worker.conn.close()
+        with self._lock:
+            if worker.generation == self.generation:
+                self._created -= 1
+            self.replaced[reason] = self.replaced.get(reason, 0) + 1
+        threading.Thread(target=self._replenish, daemon=True).start()
+
+    def _exchange(self, worker, message, timeout):
+        """Send a message and wait for the reply; returns (result, alive).
+
+        A process that misses the timeout or dies is retired.
+        """
+        try:
+            worker.conn.send(message)
+            if not worker.conn.poll(timeout):
+                self._retire(worker, 'timeout')
+                return {'exceeded': 'time', 'steps': 0}, False
+            return worker.conn.recv(), True
+        except (EOFError, OSError):
+            worker.process.join(timeout=1)
+            exitcode = worker.process.exitcode
+            if resource and exitcode == -signal.SIGXCPU:
+                self._retire(worker, 'cpu')
+                return {'exceeded': 'cpu', 'steps': 0}, False
+            self._retire(worker, 'crashed')
+            return {'error': 'The query sandbox stopped unexpectedly.', 'steps': 0}, False
+
+    def _check_in(self, worker, result):
+        """Return a process that finished its request to the pool, or replace it"""
+        if result.pop('recycle', False):
+            self._retire(worker, 'memory')
+        elif worker.generation != self.generation:
+            self._retire(worker, 'reset')
+        else:
+            self._idle.put(worker)
+
+    def run(self, request, timeout, acquire_timeout=10):
+        """Execute one execute_page() request in a sandbox process; returns its result dict.
+
+        When no process frees up within acquire_timeout the result is
+        {'busy': True, 'steps': 0} and nothing ran.
+        """
+        self._ensure_started()
+        try:
+            worker = self._idle.get(timeout=acquire_timeout)
+        except queue.Empty:
+            return {'busy': True, 'steps': 0}
+        result, alive = self._exchange(worker, request, timeout)
+        if alive:
+            self._check_in(worker, result)
+        return result
+
+    def stream(self, request, timeout, acquire_timeout=10):
+        """Run one stream_rows() request in a sandbox process, yielding its batches.
+
+        The process keeps its cursor open and is held until the last batch
+        or until the generator is closed; each batch is only computed once
+        the previous one was consumed. timeout applies per batch.
+        """
+        self._ensure_started()
+        try:
+            worker = self._idle.get(timeout=acquire_timeout)
+        except queue.Empty:
+            yield {'busy': True, 'steps': 0}
+            return
+        message, holding = dict(request, stream=True), False
+        try:
+            while True:
+                result, alive = self._exchange(worker, message, timeout)
+                if not alive:
+                    yield result
+                    return
+                if not result.get('has_more'):
+                    self._check_in(worker, result)
+                    yield result
+                    return
+                holding = True
+                yield result
+                holding, message = False, True
+        finally:
+            if holding:
+                # Closed between batches: the process drops its cursor and acknowledges
+                result, alive = self._exchange(worker, False, timeout)
+                if alive:
+                    self._check_in(worker, result)
+
+    def reset(self):
+        """Replace every process, e.g. after database.db was rebuilt on disk.
+
+        Idle processes are stopped now; busy ones when they finish.
+        """
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self.generation += 1
+            self._created = 0
+            stale = []
+            while True:
+                try:
+                    stale.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+        for worker in stale:
+            self._stop(worker)
+        for _ in range(self.size):
+            threading.Thread(target=self._replenish, daemon=True).start()
+
+    def close(self):
+        """Stop the idle processes; the pool starts again on next use"""
+        if self._pid != os.getpid():
+            return
+        self._pid = None
+        while True:
+            try:
+                self._stop(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    @staticmethod
+    def _stop(worker):
+        try:
+            worker.conn.send(None)
+        except OSError:
+            pass
+        worker.process.join(timeout=1)
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.conn.close()
+
+    def stats(self):
+        return {
+            'processes': self._created if self._pid == os.getpid() else 0,
+            'idle': self._idle.qsize() if self._pid == os.getpid() else 0,
+            'replaced': dict(self.replaced),
+            'limits': {'memory_mb': self.memory_mb, 'cpu_seconds': self.cpu_seconds, 'recycle_mb': self.recycle_mb}
+        }
@@ -0,0 +1,396 @@
+"""Contest load test for Query Clash.
+
+Starts gunicorn on a throwaway copy of the database (or targets a running
+server with --url). It then plays a full contest: every simulated player
+logs in, loads the schema, polls /api/state, works through the murder-mystery
+solution path with /api/query, verifies both rounds and submits. Admins poll
+/api/admin/stats meanwhile.
+
+Prints p50/p95/p99 latency, throughput, error and lock rates per endpoint.
+
+    python scripts/load_test.py --players 300 --workers 4 --threads 8
+    python scripts/load_test.py --url http://127.0.0.1:8080 --players 50
+    python scripts/load_test.py --mystery-db-mode memory   # compare with the default disk mode
+
+Only the standard library is used on the client side.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Queries a player types on the way to each answer, in order
+EXPLORATION = [
+    "SELECT name FROM sqlite_master WHERE type = 'table'",
+    "SELECT * FROM person LIMIT 100",
+    "SELECT * FROM crime_scene_report WHERE city = 'SQL City'",
+]
+ROUND_1 = [
+    "SELECT * FROM crime_scene_report WHERE date = 20180115 AND type = 'murder' AND city = 'SQL City'",
+    "SELECT * FROM person WHERE address_street_name = 'Northwestern Dr' ORDER BY address_number DESC LIMIT 1",
+    "SELECT * FROM person WHERE name LIKE '%Annabel%' AND address_street_name = 'Franklin Ave'",
+    "SELECT * FROM interview WHERE person_id IN (14887, 16371)",
+    "SELECT * FROM get_fit_now_member m JOIN get_fit_now_check_in c ON m.id = c.membership_id "
+    "WHERE m.id LIKE '48Z%' AND m.membership_status = 'gold' AND c.check_in_date = 20180109",
+    "SELECT p.name, dl.plate_number FROM person p JOIN drivers_license dl ON p.license_id = dl.id "
+    "WHERE dl.plate_number LIKE '%H42W%'",
+]
+ROUND_2 = [
+    "SELECT * FROM interview WHERE person_id = 67318",
+    "SELECT p.name, i.annual_income FROM drivers_license dl JOIN person p ON p.license_id = dl.id "
+    "JOIN income i ON i.ssn = p.ssn WHERE dl.hair_color = 'red' AND dl.height BETWEEN 65 AND 67 "
+    "AND dl.car_make = 'Tesla' AND dl.car_model = 'Model S'",
+    "SELECT p.name, COUNT(*) FROM facebook_event_checkin f JOIN person p ON p.id = f.person_id "
+    "WHERE f.event_name = 'SQL Symphony Concert' AND f.date BETWEEN 20171201 AND 20171231 "
+    "GROUP BY p.name HAVING COUNT(*) = 3",
+]
+# Typical mistakes along the way
+MISTAKES = [
+    "SELECT * FROM persons",
+    "SELECT * FROM person WHERE nam = 'Jeremy Bowers'",
+    "DELETE FROM person",
+]
+ANSWERS = {1: 'Jeremy Bowers', 2: 'Miranda Priestly'}
+
+
+class Stats:
+    """Latencies and outcomes per endpoint, shared by all client threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, seconds, status, body):
+        with self._lock:
+            entry = self.endpoints.setdefault(endpoint, {'latencies': [], 'errors': 0, 'locked': 0, 'rejected': 0})
+            entry['latencies'].append(seconds)
+            if status is None or status >= 500:
+                entry['errors'] += 1
+            elif status >= 400:
+                entry['rejected'] += 1
+            if 'database is locked' in body:
+                entry['locked'] += 1
+
+    def report(self, elapsed):
+        rows = []
+        for endpoint, entry in sorted(self.endpoints.items()):
+            latencies = sorted(entry['latencies'])
+            count = len(latencies)
+            rows.append({
+                'endpoint': endpoint,
+                'requests': count,
+                'rps': count / elapsed if elapsed else 0.0,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+                'error_rate': entry['errors'] / count,
+                'lock_rate': entry['locked'] / count,
+                'rejected_rate': entry['rejected'] / count,
+            })
+        return rows
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Client:
+    """One browser: its own cookie jar, timing every request into Stats"""
+
+    def __init__(self, base_url, stats, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, endpoint=None, form=None, payload=None):
+        headers = {}
+        data = None
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif payload is not None:
+            data = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        endpoint = endpoint or f"{method} {path.split('?', 1)[0]}"
+        started = time.perf_counter()
+        status, body = None, ''
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                status, body = response.status, response.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read().decode('utf-8', 'replace')
+        except (urllib.error.URLError, OSError) as e:
+            body = str(e)
+        self.stats.record(endpoint, time.perf_counter() - started, status, body)
+        return status, body
+
+    def json(self, method, path, **kwargs):
+        status, body = self.request(method, path, **kwargs)
+        try:
+            return status, json.loads(body)
+        except ValueError:
+            return status, None
+
+
+class Player(threading.Thread):
+    """Scripted contest session: login, schema, queries with state polling, verify, submit"""
+
+    def __init__(self, name, client, think_time, poll_interval, mistake_rate, stop):
+        super().__init__(daemon=True)
+        self.name = name
+        self.client = client
+        self.think_time = think_time
+        self.poll_interval = poll_interval
+        self.mistake_rate = mistake_rate
+        self.stop = stop
+        self.last_poll = 0.0
+
+    def think(self):
+        """Pause like a player reading results, polling /api/state like the game page does"""
+        pause = random.expovariate(1.0 / self.think_time) if self.think_time > 0 else 0
+        ends_at = time.monotonic() + pause
+        while not self.stop.is_set():
+            if time.monotonic() - self.last_poll >= self.poll_interval:
+                self.client.request('GET', '/api/state')
+                self.last_poll = time.monotonic()
+            remaining = ends_at - time.monotonic()
+            if remaining <= 0:
+                break
+            self.stop.wait(min(remaining, self.poll_interval))
+
+    def query(self, sql):
+        status, data = self.client.json('POST', '/api/query', payload={'sql': sql})
+        # Follow a continuation page now and then, like the LOAD MORE button
+        if data and data.get('next_token') and random.random() < 0.3:
+            self.think()
+            self.client.request('POST', '/api/query', endpoint='POST /api/query (page)',
+                                payload={'token': data['next_token']})
+
+    def solve_round(self, round_number, queries):
+        for sql in queries:
+            if self.stop.is_set():
+                return False
+            if random.random() < self.mistake_rate:
+                self.query(random.choice(MISTAKES))
+                self.think()
+            self.query(sql)
+            self.think()
+        status, investigations = self.client.json('GET', '/api/investigations')
+        if not investigations or not isinstance(investigations, list):
+            return False
+        inv_id = investigations[0]['id']
+        if random.random() < self.mistake_rate:
+            self.client.request('POST', '/api/verify', payload={'id': inv_id, 'answer': 'Annabel Miller'})
+            self.think()
+        status, result = self.client.json('POST', '/api/verify', payload={'id': inv_id, 'answer': ANSWERS[round_number]})
+        return bool(result and result.get('correct'))
+
+    def run(self):
+        self.client.request('POST', '/login', form={'name': self.name, 'password': self.name + '-pw'})
+        self.client.request('GET', '/api/schema')
+        self.client.request('GET', '/api/state')
+        self.last_poll = time.monotonic()
+        for sql in EXPLORATION:
+            self.query(sql)
+            self.think()
+        if self.solve_round(1, ROUND_1) and self.solve_round(2, ROUND_2):
+            self.client.request('POST', '/submit', form={'final_answer': ANSWERS[2]})
+
+
+class Admin(threading.Thread):
+    """Organizer keeping the dashboard open: delta polls of /api/admin/stats"""
+
+    def __init__(self, client, username, password, interval, stop):
+        super().__init__(daemon=True)
+        self.client = client
+        self.username = username
+        self.password = password
+        self.interval = interval
+        self.stop = stop
+
+    def run(self):
+        self.client.request('POST', '/login', form={'name': self.username, 'password': self.password})
+        since = epoch = None
+        while not self.stop.is_set():
+            path = '/api/admin/stats'
+            if since is not None:
+                path += f'?since={since}&epoch={epoch}'
+            status, data = self.client.json('GET', path)
+            if data and 'version' in data:
+                since, epoch = data['version'], data['epoch']
+            self.stop.wait(self.interval)
+
+
+def start_server(args, workdir):
+    """Fresh database in workdir, then gunicorn bound to a local port"""
+    sys.path.insert(0, ROOT)
+    import init_db
+    init_db.DB_PATH = os.path.join(workdir, 'database.db')
+    init_db.SOURCE_DB_PATH = os.path.join(ROOT, 'sql-murder-mystery.db')
+    init_db.init_db()
+
+    env = dict(os.environ)
+    env.update({
+        'DB_PATH': init_db.DB_PATH,
+        'QUERY_CACHE_PATH': os.path.join(workdir, 'query_cache.db'),
+        'SECRET_KEY': env.get('SECRET_KEY', 'load-test'),
+        'MYSTERY_DB_MODE': args.mystery_db_mode,
+    })
+    gunicorn = shutil.which('gunicorn')
+    command = [gunicorn] if gunicorn else [sys.executable, '-m', 'gunicorn']
+    if args.mystery_db_mode == 'memory':
+        # Load the dataset once in the master so workers share it copy-on-write
+        command.append('--preload')
+    command += ['--bind', f'127.0.0.1:{args.port}', '--workers', str(args.workers),
+                '--worker-class', 'gthread', '--threads', str(args.threads),
+                '--log-level', 'warning', 'app:app']
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f'gunicorn exited with status {server.returncode}; see {log.name}')
+        try:
+            urllib.request.urlopen(base_url + '/health', timeout=1).close()
+            return server, base_url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('gunicorn did not become ready within 30s')
+
+
+def worker_memory(server):
+    """RSS and PSS in MiB of each gunicorn worker, read from /proc (Linux only)"""
+    try:
+        with open(f'/proc/{server.pid}/task/{server.pid}/children') as f:
+            pids = [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+    workers = []
+    for pid in pids:
+        fields = {}
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[2] == 'kB':
+                        fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+        except OSError:
+            continue
+        workers.append({'pid': pid, 'rss_mib': round(fields.get('Rss', 0), 1), 'pss_mib': round(fields.get('Pss', 0), 1)})
+    return workers
+
+
+def print_report(rows, elapsed, players):
+    print(f"\n{players} players in {elapsed:.1f}s")
+    header = (f"{'endpoint':<30} {'reqs':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'max ms':>8} {'err %':>6} {'lock %':>6} {'4xx %':>6}")
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['endpoint']:<30} {row['requests']:>7} {row['rps']:>8.1f} {row['p50_ms']:>8.1f} "
+              f"{row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f} "
+              f"{row['error_rate'] * 100:>6.2f} {row['lock_rate'] * 100:>6.2f} {row['rejected_rate'] * 100:>6.2f}")
+    total = sum(row['requests'] for row in rows)
+    print(f"{'total':<30} {total:>7} {total / elapsed if elapsed else 0:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a Query Clash contest and report latency per endpoint.')
+    parser.add_argument('--players', type=int, default=300)
+    parser.add_argument('--admins', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gunicorn worker')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--url', help='target an already running server instead of starting gunicorn')
+    parser.add_argument('--ramp-up', type=float, default=10.0, help='seconds over which players join')
+    parser.add_argument('--think-time', type=float, default=1.0, help='mean pause between player actions (s)')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='/api/state polling period (s)')
+    parser.add_argument('--admin-interval', type=float, default=2.0, help='/api/admin/stats polling period (s)')
+    parser.add_argument('--mistake-rate', type=float, default=0.2, help='chance of a wrong query or answer')
+    parser.add_argument('--timeout', type=float, default=30.0, help='per-request timeout (s)')
+    parser.add_argument('--admin-user', default=os.environ.get('ADMIN_USER', 'QCA'))
+    parser.add_argument('--admin-pass', default=os.environ.get('ADMIN_PASS', '8888'))
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--seed', type=int, help='random seed for a repeatable mix')
+    parser.add_argument('--mystery-db-mode', choices=('disk', 'memory'), default='disk',
+                        help='MYSTERY_DB_MODE for the gunicorn started here')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='query-clash-load-')
+    server = None
+    try:
+        if args.url:
+            base_url = args.url
+        else:
+            server, base_url = start_server(args, workdir)
+
+        stats = Stats()
+        stop = threading.Event()
+        run_id = f'{int(time.time()) % 100000}'
+        admins = [Admin(Client(base_url, stats, args.timeout), args.admin_user, args.admin_pass,
+                        args.admin_interval, stop) for _ in range(args.admins)]
+        players = [Player(f'load{run_id}_{i}', Client(base_url, stats, args.timeout), args.think_time,
+                          args.poll_interval, args.mistake_rate, stop) for i in range(args.players)]
+
+        started = time.perf_counter()
+        for admin in admins:
+            admin.start()
+        for i, player in enumerate(players):
+            player.start()
+            if args.ramp_up and i + 1 < len(players):
+                time.sleep(args.ramp_up / len(players))
+        try:
+            for player in players:
+                player.join()
+        except KeyboardInterrupt:
+            print('Interrupted, reporting what ran so far')
+        stop.set()
+        for admin in admins:
+            admin.join(timeout=args.timeout)
+        elapsed = time.perf_counter() - started
+
+        rows = stats.report(elapsed)
+        print_report(rows, elapsed, args.players)
+        memory = worker_memory(server) if server else []
+        for worker in memory:
+            print(f"worker {worker['pid']}: rss {worker['rss_mib']} MiB, pss {worker['pss_mib']} MiB")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'players': args.players, 'workers': args.workers, 'threads': args.threads,
+                           'mystery_db_mode': args.mystery_db_mode, 'elapsed': elapsed, 'endpoints': rows,
+                           'worker_memory': memory}, f, indent=2)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
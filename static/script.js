@@ -4,6 +4,9 @@ let activeTabId = 0;
 let nextTabId = 1;
 let investigations = [];
 let remainingTime = 0;
+let roundDeadline = null; // absolute, in server epoch seconds
+let clockOffset = 0; // server clock minus local clock, in seconds
+let stateEtag = null;
 
 // Theme Logic
 const themeBtn = document.getElementById("themeToggle");
@@ -84,13 +87,14 @@ function renderSchema(schema) {
     return;
   }
 
-  for (const [table, columns] of Object.entries(schema)) {
+  for (const [table, info] of Object.entries(schema)) {
     const div = document.createElement("div");
     div.className = "schema-table";
 
     const header = document.createElement("div");
     header.className = "table-name";
     header.innerText = table;
+    header.title = `${info.row_count} rows`;
     header.onclick = () => {
       // Inject SELECT query
       const sql = `SELECT * FROM ${table}`;
@@ -105,10 +109,10 @@ function renderSchema(schema) {
 
     const colsDiv = document.createElement("div");
     colsDiv.className = "table-columns";
-    columns.forEach((col) => {
+    info.columns.forEach((col) => {
       const colDiv = document.createElement("div");
       colDiv.className = "column-name";
-      colDiv.innerText = col;
+      colDiv.innerText = col.type ? `${col.name} (${col.type})` : col.name;
       colsDiv.appendChild(colDiv);
     });
 
@@ -120,9 +124,15 @@ function renderSchema(schema) {
 
 async function syncState() {
   try {
-    const res = await fetch("/api/state");
+    // Conditional request: an in-sync client gets an empty 304
+    const headers = stateEtag ? { "If-None-Match": stateEtag } : {};
+    const res = await fetch("/api/state", { headers, cache: "no-store" });
+    if (res.status === 304) return;
     if (res.ok) {
       const data = await res.json();
+      stateEtag = res.headers.get("ETag");
+      roundDeadline = data.deadline;
+      clockOffset = data.server_time - Date.now() / 1000;
       remainingTime = data.remaining_time;
       document.getElementById("userName").textContent = data.name;
 
@@ -190,8 +200,10 @@ async function loadInvestigations() {
 let timerExpired = false; // Prevent multiple redirects
 
 function updateTimer() {
+  if (roundDeadline !== null) {
+    remainingTime = roundDeadline - (Date.now() / 1000 + clockOffset);
+  }
   if (remainingTime > 0) {
-    remainingTime--;
     const totalSeconds = Math.floor(remainingTime);
     const h = Math.floor(totalSeconds / 3600)
       .toString()
@@ -410,39 +422,120 @@ async function runQuery() {
 
   resArea.innerHTML = '<div class="result-msg">EXECUTING...</div>';
 
+  const data = await postQuery({ sql });
+
+  if (data.code === "RATE_LIMITED") {
+    showRetryCountdown(resArea, data.retry_after);
+  } else if (data.error) {
+    resArea.innerHTML = `<div class="error-msg">ERROR: ${data.error}</div>`;
+  } else {
+    renderTable(data);
+  }
+}
+
+// Download the full result as CSV; the server streams it, so the browser writes it straight to disk
+function exportQuery() {
+  const form = document.createElement("form");
+  form.method = "POST";
+  form.action = "/api/export";
+  form.target = "_blank"; // errors come back as JSON, keep them out of the terminal tab
+  [["sql", document.getElementById("sqlEditor").value], ["format", "csv"]].forEach(([name, value]) => {
+    const input = document.createElement("input");
+    input.type = "hidden";
+    input.name = name;
+    input.value = value;
+    form.appendChild(input);
+  });
+  document.body.appendChild(form);
+  form.submit();
+  form.remove();
+}
+
+// Rate-limited: hold the EXECUTE button and count down the server's Retry-After hint
+function showRetryCountdown(resArea, seconds) {
+  const runBtn = document.querySelector(".run-btn");
+  let remaining = seconds;
+  const render = () => {
+    resArea.innerHTML = `<div class="error-msg">RATE LIMITED: TOO MANY QUERIES. RETRY IN ${remaining}s.</div>`;
+  };
+  render();
+  runBtn.disabled = true;
+  const timer = setInterval(() => {
+    remaining -= 1;
+    if (remaining > 0) {
+      render();
+      return;
+    }
+    clearInterval(timer);
+    runBtn.disabled = false;
+    resArea.innerHTML = '<div class="result-msg">READY. RUN THE QUERY AGAIN.</div>';
+  }, 1000);
+}
+
+// Results come back columnar (columns + rows arrays); large pages arrive gzip-compressed
+async function postQuery(body) {
   const res = await fetch("/api/query", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ sql }),
+    body: JSON.stringify({ ...body, format: "columnar" }),
   });
+  return res.json();
+}
 
-  const data = await res.json();
+// Fetch the next page of the current result and append it to the table
+async function loadMoreRows(button) {
+  button.disabled = true;
+  button.innerText = "LOADING...";
 
+  const data = await postQuery({ token: button.dataset.token });
+
+  if (data.code === "RATE_LIMITED") {
+    button.innerText = `RETRY IN ${data.retry_after}s`;
+    setTimeout(() => {
+      button.disabled = false;
+      button.innerText = "LOAD MORE";
+    }, data.retry_after * 1000);
+    return;
+  }
   if (data.error) {
-    resArea.innerHTML = `<div class="error-msg">ERROR: ${data.error}</div>`;
-  } else {
-    renderTable(data);
+    button.insertAdjacentHTML("afterend", `<div class="error-msg">ERROR: ${data.error}</div>`);
+    button.remove();
+    return;
   }
+  renderTable(data, true);
 }
 
-function renderTable(data) {
-  if (!data.results || data.results.length === 0) {
-    document.getElementById("resultsArea").innerHTML =
-      '<div class="result-msg">QUERY OK. NO DATA RETURNED.</div>';
-    return;
+function renderRows(data) {
+  const html = new Array(data.rows.length);
+  for (let i = 0; i < data.rows.length; i++) {
+    html[i] = `<tr><td>${data.rows[i].map(String).join("</td><td>")}</td></tr>`;
   }
+  return html.join("");
+}
 
-  const cols = data.columns;
-  let html = "<table><thead><tr>";
-  cols.forEach((c) => (html += `<th>${c}</th>`));
-  html += "</tr></thead><tbody>";
+function renderMoreButton(data) {
+  if (!data.has_more) return "";
+  return `<button class="cyber-btn load-more" data-token="${data.next_token}" onclick="loadMoreRows(this)">LOAD MORE</button>`;
+}
 
-  data.results.forEach((row) => {
-    html += "<tr>";
-    cols.forEach((c) => (html += `<td>${row[c]}</td>`));
-    html += "</tr>";
-  });
+function renderTable(data, append = false) {
+  const resArea = document.getElementById("resultsArea");
+
+  if (append) {
+    resArea.querySelector("tbody").insertAdjacentHTML("beforeend", renderRows(data));
+    resArea.querySelector(".load-more").remove();
+    resArea.insertAdjacentHTML("beforeend", renderMoreButton(data));
+    return;
+  }
+
+  if (!data.rows || data.rows.length === 0) {
+    resArea.innerHTML = '<div class="result-msg">QUERY OK. NO DATA RETURNED.</div>';
+    return;
+  }
 
+  let html = `<table><thead><tr><th>${data.columns.join("</th><th>")}</th></tr></thead><tbody>`;
+  html += renderRows(data);
   html += "</tbody></table>";
-  document.getElementById("resultsArea").innerHTML = html;
+  html += renderMoreButton(data);
+  resArea.innerHTML = html;
 }
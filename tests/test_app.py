@@ -1,6 +1,16 @@
 import unittest
+from unittest.mock import patch
 import json
-from app import app, get_db
+import gzip
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import init_db
+import app as app_module
+from sandbox import fetch_rows
+from app import app, get_db, query_pool, counter_buffer
 
 class QueryClashTestCase(unittest.TestCase):
     def setUp(self):
@@ -10,6 +20,8 @@ class QueryClashTestCase(unittest.TestCase):
         self.app_context.push()
         
         # Reset DB for test
+        counter_buffer.discard('TestAgent')
+        app_module.query_admission.forget('TestAgent')
         db = get_db()
         db.execute('DELETE FROM participants WHERE name = "TestAgent"')
         db.execute('DELETE FROM investigation_progress WHERE name = "TestAgent"')
@@ -42,6 +54,15 @@ class QueryClashTestCase(unittest.TestCase):
         data = json.loads(rv.data)
         self.assertIn('results', data)
         self.assertEqual(len(data['results']), 4)
+
+        # 1b. No space after SELECT, and a leading comment, are still queries
+        for sql in ('SELECT*FROM person LIMIT 1', '-- first person\nselect id FROM person LIMIT 1',
+                    '/* cte */ WITH p AS (SELECT id FROM person) SELECT * FROM p LIMIT 1'):
+            self.assertEqual(len(json.loads(self.app.post('/api/query', json={'sql': sql}).data)['results']), 1, sql)
+        self.assertIn('error', json.loads(
+            self.app.post('/api/query', json={'sql': '-- SELECT\nDELETE FROM person'}).data))
+        self.assertEqual(app_module.check_player_sql('/* SELECT */ PRAGMA table_info(person)'),
+                         'Only SELECT queries are allowed.')
         
         # 2. Blocked Query (DROP - caught by start check)
         rv = self.app.post('/api/query', json={'sql': 'DROP TABLE suspects'})
@@ -61,6 +82,28 @@ class QueryClashTestCase(unittest.TestCase):
         data = json.loads(rv.data)
         self.assertIn('error', data)
         
+    def test_sql_sandbox(self):
+        self.login()
+
+        # Hidden game tables are denied at prepare time
+        rv = self.app.post('/api/query', json={'sql': 'SELECT password FROM participants'})
+        self.assertIn('forbidden', json.loads(rv.data)['error'].lower())
+        rv = self.app.post('/api/query', json={'sql': 'SELECT * FROM person WHERE id IN (SELECT id FROM investigations)'})
+        self.assertIn('forbidden', json.loads(rv.data)['error'].lower())
+
+        # Keywords inside literals are no longer false positives
+        rv = self.app.post('/api/query', json={'sql': "SELECT * FROM interview WHERE transcript LIKE '%drop%update%'"})
+        self.assertNotIn('error', json.loads(rv.data))
+
+        rv = self.app.post('/api/query', json={'sql': "WITH p AS (SELECT id FROM person LIMIT 2) SELECT * FROM p"})
+        self.assertEqual(len(json.loads(rv.data)['results']), 2)
+
+        # Table-valued functions work; the pragma ones are refused as the PRAGMA they run
+        rv = self.app.post('/api/query', json={'sql': "SELECT value FROM json_each('[1,2,3]')"})
+        self.assertEqual([row['value'] for row in json.loads(rv.data)['results']], [1, 2, 3])
+        rv = self.app.post('/api/query', json={'sql': "SELECT * FROM pragma_table_info('person')"})
+        self.assertEqual(json.loads(rv.data)['error'], 'Command PRAGMA is forbidden.')
+
     def test_round_progression(self):
         self.login()
         
@@ -84,6 +127,191 @@ class QueryClashTestCase(unittest.TestCase):
         rv = self.app.get('/api/state')
         self.assertEqual(json.loads(rv.data)['round'], 2)
         
+    def test_verify_uses_investigation_catalog(self):
+        self.login()
+        q1 = json.loads(self.app.get('/api/investigations').data)[0]
+        
+        # Wrong answers are rejected from the catalog without touching the database
+        with patch.object(app_module, 'get_db', side_effect=AssertionError('unexpected db access')):
+            rv = self.app.post('/api/verify', json={'id': q1['id'], 'answer': 'Someone Else'})
+        self.assertFalse(json.loads(rv.data)['correct'])
+        self.assertEqual(self.app.post('/api/verify', json={'id': 999, 'answer': 'x'}).status_code, 400)
+        
+        # Answers are compared case- and whitespace-insensitively
+        rv = self.app.post('/api/verify', json={'id': q1['id'], 'answer': '  jeremy   BOWERS '})
+        self.assertTrue(json.loads(rv.data)['correct'])
+        user = get_db().execute('SELECT current_round, elapsed_time FROM participants WHERE name = "TestAgent"').fetchone()
+        self.assertEqual(user['current_round'], 2)
+        self.assertIsNotNone(user['elapsed_time'])
+        
+        # Solving again is idempotent
+        self.app.post('/api/verify', json={'id': q1['id'], 'answer': 'Jeremy Bowers'})
+        self.assertEqual(json.loads(self.app.get('/api/state').data)['round'], 2)
+
+    def test_mystery_db_memory_mode(self):
+        self.login()
+        try:
+            with patch.object(app_module, 'MYSTERY_DB_MODE', 'memory'):
+                query_pool.reset()
+                rv = self.app.post('/api/query', json={'sql': 'SELECT COUNT(*) AS n FROM person'})
+                self.assertGreater(json.loads(rv.data)['results'][0]['n'], 0)
+                conn = query_pool.acquire()
+                try:
+                    # Game-state tables are not copied
+                    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                    self.assertIn('person', tables)
+                    self.assertNotIn('participants', tables)
+                finally:
+                    query_pool.release(conn)
+                self.assertGreater(app_module.mystery_memory.stats()['bytes'], 0)
+        finally:
+            query_pool.reset()
+
+    def test_columnar_query_format(self):
+        self.login()
+        sql = 'SELECT * FROM person ORDER BY id'
+        rows_json = json.loads(self.app.post('/api/query', json={'sql': sql}).data)
+        rv = self.app.post('/api/query', json={'sql': sql, 'format': 'columnar'})
+        self.assertEqual(rv.headers.get('Content-Encoding'), None)
+        data = json.loads(rv.data)
+        self.assertNotIn('results', data)
+        self.assertEqual(data['columns'], rows_json['columns'])
+        self.assertEqual([dict(zip(data['columns'], row)) for row in data['rows']], rows_json['results'])
+        self.assertLess(len(rv.data), len(self.app.post('/api/query', json={'sql': sql}).data))
+        
+        # Compressed when the client accepts gzip; continuation pages keep the format
+        rv = self.app.post('/api/query', json={'sql': sql, 'format': 'columnar'}, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        data = json.loads(gzip.decompress(rv.data))
+        more = json.loads(self.app.post('/api/query', json={'token': data['next_token'], 'format': 'columnar'}).data)
+        self.assertEqual(more['offset'], len(data['rows']))
+        self.assertIsInstance(more['rows'][0], list)
+
+    def test_export_streams_full_result(self):
+        self.login()
+        count = get_db().execute('SELECT COUNT(*) FROM person').fetchone()[0]
+        rv = self.app.post('/api/export', json={'sql': 'SELECT id, name FROM person ORDER BY id'})
+        self.assertEqual(rv.mimetype, 'text/csv')
+        self.assertTrue(rv.is_streamed)
+        lines = rv.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,name')
+        self.assertEqual(len(lines), count + 1)  # not capped at a page
+        
+        # NDJSON stops at EXPORT_MAX_ROWS with a final marker line
+        with patch.object(app_module, 'EXPORT_MAX_ROWS', 10):
+            rv = self.app.post('/api/export', data={'sql': 'SELECT id FROM person', 'format': 'ndjson'})
+            lines = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(lines), 11)
+        self.assertIn('EXPORT_MAX_ROWS', lines[-1]['error'])
+        
+        # Same sandbox as /api/query, and the execution slot is handed back
+        rv = self.app.post('/api/export', json={'sql': 'SELECT * FROM participants'})
+        self.assertIn('forbidden', json.loads(rv.data)['error'])
+        self.assertEqual(app_module.query_admission.stats()['running'], 0)
+
+        # Time spent waiting on the client is not charged to the budget
+        idle = app_module.query_pool.stats()['idle']
+        with patch.object(app_module, 'EXPORT_TIMEOUT_MS', 100):
+            chunks = iter(self.app.post('/api/export', json={'sql': 'SELECT id FROM person'}).response)
+            next(chunks)
+            time.sleep(0.2)
+            self.assertNotIn(b'#', b''.join(chunks))
+        
+        # A client that stops reading hands back its connection and slot
+        with patch.object(app_module, 'EXPORT_STALL_SECONDS', 0.05):
+            chunks = iter(self.app.post('/api/export', json={'sql': 'SELECT id FROM person'}).response)
+            next(chunks)
+            time.sleep(0.2)
+            self.assertEqual(app_module.query_admission.stats()['running'], 0)
+            self.assertEqual(app_module.query_pool.stats()['idle'], idle)
+            self.assertIn(b'EXPORT_STALL_SECONDS', list(chunks)[-1])
+
+    def test_contest_event_log(self):
+        app_module.event_log.flush()  # events left over from other tests
+        db = get_db()
+        db.execute('DELETE FROM contest_events WHERE name = "TestAgent"')
+        db.commit()
+        after = db.execute('SELECT COALESCE(MAX(id), 0) FROM contest_events').fetchone()[0]
+        
+        self.login()
+        self.app.post('/api/query', json={'sql': 'SELECT COUNT(*) FROM person'})
+        rv = self.app.post('/api/query', json={'sql': 'SELECT id FROM person'})
+        self.app.post('/api/query', json={'token': json.loads(rv.data)['next_token']})
+        q1 = json.loads(self.app.get('/api/investigations').data)[0]
+        self.app.post('/api/verify', json={'id': q1['id'], 'answer': 'Nobody'})
+        self.app.post('/api/verify', json={'id': q1['id'], 'answer': 'Jeremy Bowers'})
+        self.app.post('/submit', data={'final_answer': 'Miranda Priestly'})
+        
+        app_module.event_log.flush()
+        kinds = [e['kind'] for e in app_module.event_log.replay(after) if e['name'] == 'TestAgent']
+        self.assertEqual(kinds, ['login', 'query', 'query', 'query', 'verify', 'verify', 'advance', 'submit'])
+        
+        # Players cannot read the log
+        rv = self.app.post('/api/query', json={'sql': 'SELECT * FROM contest_events'})
+        self.assertIn('forbidden', json.loads(rv.data)['error'])
+        
+        # The report is replayed from the log, so it survives an admin reset
+        self.login_admin()
+        self.app.post('/admin/reset-user/TestAgent')
+        self.assertEqual(self.app.get('/api/admin/report').status_code, 200)
+        report = app_module.contest_report(app_module.event_log.replay(after, by_time=True))
+        agent = next(p for p in report['players'] if p['name'] == 'TestAgent')
+        self.assertEqual((agent['verify_attempts'], agent['correct_answers'], agent['resets']), (2, 1, 1))
+        self.assertEqual(agent['queries'], 3)  # the denied read counts; the LOAD MORE page does not
+        self.assertEqual(agent['round'], 1)
+        self.assertIsNone(agent['submission'])
+        rv = self.app.get(f'/api/admin/event-log?after={after}&kind=admin')
+        self.assertEqual(json.loads(rv.data)['events'][-1]['data'], {'action': 'reset_user', 'target': 'TestAgent'})
+
+        # Another worker's batch can land after the reset with an earlier timestamp
+        reset_ts = json.loads(rv.data)['events'][-1]['ts']
+        db.execute('INSERT INTO contest_events (ts, kind, name, data) VALUES (?, "advance", "TestAgent", \'{"round":3}\')',
+                   (reset_ts - 1,))
+        db.commit()
+        report = app_module.contest_report(app_module.event_log.replay(after, by_time=True))
+        self.assertEqual(next(p for p in report['players'] if p['name'] == 'TestAgent')['round'], 1)
+
+    def test_analytics_snapshot(self):
+        app_module.analytics_snapshot.clear()
+        rv = self.app.get('/analytics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'TestAgent', rv.data)
+        self.assertIn('max-age', rv.headers['Cache-Control'])
+        
+        # Conditional GET against the same snapshot
+        rv = self.app.get('/analytics', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        
+        # Rebuilt at most once per TTL, however many requests arrive
+        with patch.object(app_module.leaderboard, 'snapshot', side_effect=AssertionError('rebuilt')):
+            self.app.get('/analytics?page=2')
+            rv = self.app.get('/analytics?top=1')
+        self.assertEqual(rv.data.count(b'<td>ROUND'), 1)
+        
+        with patch.object(app_module, 'ANALYTICS_PAGE_SIZE', 1):
+            rv = self.app.get('/analytics?top=2&page=2')
+        self.assertEqual(rv.data.count(b'<td>ROUND'), 1)
+        self.assertIn(b'PAGE 2 / 2', rv.data)
+
+    def test_static_assets_fingerprinted(self):
+        digest = app_module.static_assets.digest('script.js')
+        rv = self.app.get('/')
+        self.assertIn(f'style.css?v={app_module.static_assets.digest("style.css")}'.encode(), rv.data)
+        
+        rv = self.app.get(f'/static/script.js?v={digest}', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', rv.headers['Cache-Control'])
+        with open(os.path.join(app.static_folder, 'script.js'), 'rb') as f:
+            self.assertEqual(gzip.decompress(rv.data), f.read())
+        rv = self.app.get(f'/static/script.js?v={digest}', headers={'Accept-Encoding': 'gzip', 'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        
+        # Unversioned URLs and images are served as-is and revalidated
+        rv = self.app.get('/static/schema.png')
+        self.assertIsNone(rv.headers.get('Content-Encoding'))
+        self.assertEqual(rv.headers['Cache-Control'], 'no-cache')
+        rv.close()
+
     def test_final_submission(self):
         self.login()
         # Fast forward to submission
@@ -98,6 +326,388 @@ class QueryClashTestCase(unittest.TestCase):
         self.assertIsNotNone(sub)
         self.assertEqual(sub['final_answer'], 'Miranda Priestly')
 
+    def login_admin(self):
+        return self.app.post('/login', data={'name': app_module.ADMIN_USER, 'password': app_module.ADMIN_PASS})
+
+    def test_query_budget(self):
+        self.login()
+        original = app_module.QUERY_MAX_STEPS
+        app_module.QUERY_MAX_STEPS = 10000
+        try:
+            rv = self.app.post('/api/query', json={'sql': 'SELECT COUNT(*) FROM person, income'})
+        finally:
+            app_module.QUERY_MAX_STEPS = original
+        data = json.loads(rv.data)
+        self.assertEqual(data['code'], 'QUERY_BUDGET_EXCEEDED')
+        self.assertEqual(data['results'], [])
+
+        # The connection is usable again once the budget has fired
+        rv = self.app.post('/api/query', json={'sql': 'SELECT * FROM person LIMIT 2'})
+        self.assertEqual(len(json.loads(rv.data)['results']), 2)
+
+        self.login_admin()
+        counters = json.loads(self.app.get('/api/admin/metrics').data)['counters']
+        self.assertGreaterEqual(counters['query_budget_exceeded'], 1)
+
+    def test_query_pagination(self):
+        self.login()
+        rv = self.app.post('/api/query', json={'sql': 'SELECT id FROM person ORDER BY id'})
+        first = json.loads(rv.data)
+        self.assertEqual(len(first['results']), app_module.QUERY_PAGE_SIZE)
+        self.assertTrue(first['has_more'])
+
+        rv = self.app.post('/api/query', json={'token': first['next_token']})
+        second = json.loads(rv.data)
+        self.assertEqual(second['columns'], ['id'])
+        self.assertEqual(second['offset'], app_module.QUERY_PAGE_SIZE)
+        self.assertGreater(second['results'][0]['id'], first['results'][-1]['id'])
+
+        rv = self.app.post('/api/query', json={'sql': 'SELECT * FROM person LIMIT 3'})
+        data = json.loads(rv.data)
+        self.assertFalse(data['has_more'])
+        self.assertIsNone(data['next_token'])
+
+        # SQL ending in a comment still pages (continuations wrap it in a subquery)
+        conn = query_pool.acquire()
+        try:
+            columns, rows, has_more = fetch_rows(conn, 'SELECT id FROM person -- all people', 50, 5)
+        finally:
+            query_pool.release(conn)
+        self.assertEqual((columns, len(rows), has_more), (['id'], 5, True))
+
+        for token in ('forged', 123, ['forged'], {'sql': 'SELECT 1'}):
+            rv = self.app.post('/api/query', json={'token': token})
+            self.assertEqual(rv.status_code, 400, token)
+            self.assertEqual(json.loads(rv.data)['error'], 'Invalid continuation token.')
+
+    def test_query_result_cache(self):
+        self.login()
+        cache = app_module.result_cache
+        cache.clear()
+        before = cache.stats()
+        sql = "SELECT * FROM crime_scene_report WHERE date = 20180115 AND city = 'SQL City'"
+        first = json.loads(self.app.post('/api/query', json={'sql': sql}).data)
+        # Same statement modulo whitespace and a trailing semicolon is served from cache
+        second = json.loads(self.app.post('/api/query', json={'sql': '  ' + sql.replace(' WHERE ', '\n  WHERE\t') + ';'}).data)
+        self.assertEqual(first['results'], second['results'])
+        after = cache.stats()
+        self.assertEqual(after['hits'], before['hits'] + 1)
+        self.assertEqual(app_module.normalize_sql("SELECT  'a  b'\n FROM t ;"), "SELECT 'a  b' FROM t")
+        
+        # A comment ends at its newline: these are different queries
+        filtered = json.loads(self.app.post('/api/query', json={'sql': 'SELECT COUNT(*) AS n FROM person -- x\nWHERE id < 0'}).data)
+        unfiltered = json.loads(self.app.post('/api/query', json={'sql': 'SELECT COUNT(*) AS n FROM person -- x WHERE id < 0'}).data)
+        self.assertEqual(filtered['results'][0]['n'], 0)
+        self.assertGreater(unfiltered['results'][0]['n'], 0)
+        
+        # Non-deterministic SQL is never cached
+        self.assertFalse(app_module.is_deterministic_sql("SELECT julianday('now')"))
+        self.assertFalse(app_module.is_deterministic_sql('SELECT random() FROM person LIMIT 1'))
+        stats = cache.stats()
+        for _ in range(2):
+            self.app.post('/api/query', json={'sql': 'SELECT random() AS r'})
+        self.assertEqual(cache.stats()['hits'], stats['hits'])
+
+    def test_query_count_write_behind(self):
+        self.login()
+        for _ in range(3):
+            self.app.post('/api/query', json={'sql': 'SELECT 1'})
+        self.assertEqual(counter_buffer.pending('TestAgent'), 3)
+
+        counter_buffer.flush()
+        db = get_db()
+        count = db.execute('SELECT query_count FROM participants WHERE name = "TestAgent"').fetchone()[0]
+        self.assertEqual(count, 3)
+        self.assertEqual(counter_buffer.pending('TestAgent'), 0)
+
+    def test_state_is_a_conditional_pure_read(self):
+        self.login()
+        rv = self.app.get('/api/state')
+        data = json.loads(rv.data)
+        self.assertIn('deadline', data)
+        self.assertIsNotNone(rv.headers.get('ETag'))
+
+        rv = self.app.get('/api/state', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+        # Polling never writes the elapsed time back
+        db = get_db()
+        elapsed = db.execute('SELECT elapsed_time FROM participants WHERE name = "TestAgent"').fetchone()[0]
+        self.assertEqual(elapsed, 0)
+
+        # A legacy row with an unreadable start keeps its time instead of expiring at once
+        legacy = {'round_deadline': None, 'round_start_time': 'not a date', 'elapsed_time': 120}
+        self.assertEqual(app_module.elapsed_seconds(legacy), 120)
+        self.assertGreater(app_module.participant_deadline(legacy), time.time())
+
+    def test_storage_settings(self):
+        settings = app_module.configure_database()
+        self.assertEqual(settings['journal_mode'].upper(), app_module.DB_JOURNAL_MODE)
+        self.assertEqual(settings['busy_timeout'], app_module.DB_BUSY_TIMEOUT_MS)
+        busy_timeout = get_db().execute('PRAGMA busy_timeout').fetchone()[0]
+        self.assertEqual(busy_timeout, app_module.DB_BUSY_TIMEOUT_MS)
+
+    def test_admin_stats_deltas(self):
+        leaderboard = app_module.leaderboard
+        leaderboard.sync()
+        self.login_admin()
+        full = json.loads(self.app.get('/api/admin/stats').data)
+        self.assertTrue(full['full'])
+        self.assertIn('TestAgent', [p['name'] for p in full['stats']])
+
+        # Nothing changed: an empty delta
+        params = f"?since={full['version']}&epoch={full['epoch']}"
+        delta = json.loads(self.app.get('/api/admin/stats' + params).data)
+        self.assertFalse(delta['full'])
+        self.assertEqual(delta['stats'], [])
+
+        # A query by the player shows up as a one-row delta
+        self.login()
+        self.app.post('/api/query', json={'sql': 'SELECT 1'})
+        self.login_admin()
+        delta = json.loads(self.app.get('/api/admin/stats' + params).data)
+        self.assertEqual([p['name'] for p in delta['stats']], ['TestAgent'])
+        self.assertGreater(delta['version'], full['version'])
+
+        # Unknown epoch (e.g. another worker): full snapshot
+        other = json.loads(self.app.get(f"/api/admin/stats?since={full['version']}&epoch=other").data)
+        self.assertTrue(other['full'])
+
+    def test_admin_event_stream(self):
+        app_module.leaderboard.sync()
+        self.login_admin()
+        rv = self.app.get('/api/admin/events', buffered=False)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        chunks = iter(rv.response)
+        self.assertTrue(next(chunks).startswith(b'retry:'))
+        event = next(chunks).decode('utf-8')
+        self.assertIn('event: leaderboard', event)
+        payload = json.loads(event.split('data: ', 1)[1])
+        self.assertTrue(payload['full'])
+        rv.close()
+
+        # A reconnect resumes from Last-Event-ID, not from the stale position in its URL
+        event_id = event.split('id: ', 1)[1].split('\n', 1)[0]
+        with patch.object(app_module, 'SSE_HEARTBEAT_SECONDS', 0.05):
+            for headers, resumed in (({}, False), ({'Last-Event-ID': event_id}, True)):
+                rv = self.app.get('/api/admin/events?since=0&epoch=stale', headers=headers, buffered=False)
+                chunks = iter(rv.response)
+                next(chunks)
+                self.assertEqual(next(chunks).startswith(b': heartbeat'), resumed)
+                rv.close()
+
+    def test_schema_catalog(self):
+        self.login()
+        rv = self.app.get('/api/schema')
+        schema = json.loads(rv.data)
+        self.assertIn('person', schema)
+        self.assertNotIn('participants', schema)
+        self.assertIn('license_id', [c['name'] for c in schema['person']['columns']])
+        self.assertGreater(schema['person']['row_count'], 0)
+        self.assertTrue(rv.headers['Cache-Control'].startswith('private, max-age'))  # needs a session
+
+        rv = self.app.get('/api/schema', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+    def test_index_advisor(self):
+        app_module.query_stats.clear()
+        self.login()
+        for make in ('Tesla', 'Audi'):
+            self.app.post('/api/query', json={'sql': f"SELECT * FROM drivers_license WHERE car_make = '{make}'"})
+        samples = app_module.query_stats.snapshot()
+        self.assertEqual(list(samples.values())[0]['count'], 2)
+
+        self.login_admin()
+        report = json.loads(self.app.get('/api/admin/index-advisor').data)
+        top = report['recommendations'][0]
+        self.assertEqual((top['table'], top['columns']), ('drivers_license', ['car_make']))
+        self.assertEqual(top['scans_removed'], 2)
+        self.assertEqual(report['queries'][0]['full_scans'], ['SCAN drivers_license'])
+
+    def test_slow_query_log(self):
+        app_module.query_stats.clear()
+        app_module.result_cache.clear()
+        original = app_module.query_stats.slow_ms
+        app_module.query_stats.slow_ms = 0
+        try:
+            self.login()
+            for person_id in (14887, 16371):
+                self.app.post('/api/query', json={'sql': f'SELECT * FROM interview WHERE person_id = {person_id}'})
+            self.app.post('/api/query', json={'sql': 'SELECT * FROM interview WHERE person_id = 14887'})
+        finally:
+            app_module.query_stats.slow_ms = original
+
+        self.login_admin()
+        report = json.loads(self.app.get('/api/admin/queries').data)
+        shape = report['shapes'][0]
+        self.assertEqual(shape['fingerprint'], 'select * from interview where person_id = ?')
+        self.assertEqual((shape['count'], shape['executions'], shape['cache_hits']), (3, 2, 1))
+        self.assertEqual(shape['top_users'], [{'name': 'TestAgent', 'count': 3}])
+        self.assertEqual(len(report['slow']), 2)
+        self.assertEqual(report['slow'][0]['user'], 'TestAgent')
+
+    def test_query_admission(self):
+        self.login()
+        # The clock is frozen so the bucket cannot refill mid-burst, then moved on by one token's worth
+        now = time.monotonic()
+        with patch.object(app_module.time, 'monotonic', return_value=now) as clock:
+            for _ in range(app_module.QUERY_BURST):
+                self.app.post('/api/query', json={'sql': 'SELECT 1'})
+            rv = self.app.post('/api/query', json={'sql': 'SELECT 1'})
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(json.loads(rv.data)['code'], 'RATE_LIMITED')
+            self.assertGreaterEqual(int(rv.headers['Retry-After']), 1)
+            clock.return_value = now + 1.01 / app_module.QUERY_RATE_PER_SEC
+            self.assertEqual(self.app.post('/api/query', json={'sql': 'SELECT 1'}).status_code, 200)
+            self.assertEqual(self.app.post('/api/query', json={'sql': 'SELECT 1'}).status_code, 429)
+
+        # One slot: a second query from the same player is refused, another player waits its turn
+        admission = app_module.QueryAdmission(rate=0, burst=1, per_user=1, slots=1, queue_max=4, queue_timeout=5)
+        self.assertEqual(admission.acquire('alice'), (0, None))
+        retry_after, reason = admission.acquire('alice')
+        self.assertGreater(retry_after, 0)
+        self.assertEqual(admission.REFUSALS[reason], 'Your previous query is still running.')
+        results = {}
+        waiter = threading.Thread(target=lambda: results.setdefault('bob', admission.acquire('bob')))
+        waiter.start()
+        while admission.stats()['queued'] == 0:
+            time.sleep(0.01)
+        self.assertEqual(admission.stats()['waiting'], {'bob': 1})
+        admission.release('alice')
+        waiter.join(timeout=5)
+        self.assertEqual(results['bob'], (0, None))
+        self.assertEqual(admission.stats()['running'], 1)
+
+    def test_process_sandbox(self):
+        sandbox = app_module.ProcessSandbox(app_module.DB_PATH, size=1, memory_mb=256, cpu_seconds=5)
+        try:
+            result = sandbox.run({'sql': 'SELECT name FROM person ORDER BY id', 'page_size': 3}, timeout=10)
+            self.assertEqual(len(result['rows']), 3)
+            self.assertTrue(result['has_more'])
+            result = sandbox.run({'sql': 'SELECT * FROM participants'}, timeout=10)
+            self.assertIn('participants', result['denied'])
+
+            # A statement outliving the caller's timeout gets its process killed and replaced
+            endless = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT COUNT(*) FROM c'
+            results = {}
+            runner = threading.Thread(target=lambda: results.setdefault('endless', sandbox.run(
+                {'sql': endless, 'timeout_ms': 60000, 'max_steps': 10 ** 12}, timeout=0.5)))
+            runner.start()
+            while sandbox.stats()['idle']:
+                time.sleep(0.01)
+            # Meanwhile the only process is taken, so another query is turned away rather than failing
+            self.assertEqual(sandbox.run({'sql': 'SELECT 1'}, timeout=10, acquire_timeout=0.1), {'busy': True, 'steps': 0})
+            runner.join(timeout=5)
+            self.assertEqual(results['endless']['exceeded'], 'time')
+            self.assertEqual(sandbox.stats()['replaced'], {'timeout': 1})
+            result = sandbox.run({'sql': 'SELECT COUNT(*) FROM person'}, timeout=10)
+            self.assertGreater(result['rows'][0][0], 0)
+        finally:
+            sandbox.close()
+
+        # The endpoint behaves the same on the process backend
+        original = app_module.QUERY_BACKEND
+        app_module.QUERY_BACKEND = 'process'
+        try:
+            app_module.result_cache.clear()
+            self.login()
+            rv = self.app.post('/api/query', json={'sql': 'SELECT * FROM person WHERE id = 10000'})
+            self.assertEqual(len(json.loads(rv.data)['results']), 1)
+
+            # Exports stream one cursor from one process, which goes back to the pool when the client leaves
+            count = get_db().execute('SELECT COUNT(*) FROM person').fetchone()[0]
+            replaced = app_module.process_sandbox.stats()['replaced']
+            rv = self.app.post('/api/export', json={'sql': 'SELECT id FROM person ORDER BY name'})
+            self.assertEqual(len(rv.get_data(as_text=True).splitlines()), count + 1)
+            rv = self.app.post('/api/export', json={'sql': 'SELECT id FROM person'})
+            next(iter(rv.response))
+            self.assertEqual(app_module.process_sandbox.stats()['idle'], app_module.process_sandbox.size - 1)
+            rv.close()
+            self.assertEqual(app_module.process_sandbox.stats()['idle'], app_module.process_sandbox.size)
+            self.assertEqual(app_module.process_sandbox.stats()['replaced'], replaced)
+        finally:
+            app_module.QUERY_BACKEND = original
+            app_module.process_sandbox.close()
+
+    def test_prometheus_metrics(self):
+        self.login()
+        self.app.post('/api/query', json={'sql': 'SELECT * FROM person LIMIT 3'})
+        self.assertEqual(self.app.get('/metrics').status_code, 403)
+
+        self.login_admin()
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        body = rv.data.decode('utf-8')
+        self.assertIn('# TYPE query_clash_http_request_duration_seconds histogram', body)
+        self.assertIn('route="/api/query"', body)
+        self.assertIn('query_clash_db_time_seconds_count{', body)
+        self.assertIn('query_clash_query_rows_bucket{', body)
+        self.assertIn('query_clash_query_cache_lookups_total{', body)
+
+        original = app_module.METRICS_TOKEN
+        app_module.METRICS_TOKEN = 'scrape-me'
+        try:
+            with app.test_client() as scraper:
+                self.assertEqual(scraper.get('/metrics').status_code, 403)
+                rv = scraper.get('/metrics', headers={'Authorization': 'Bearer scrape-me'})
+                self.assertEqual(rv.status_code, 200)
+        finally:
+            app_module.METRICS_TOKEN = original
+
+    def test_init_db_reset_game_keeps_mystery_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'game.db')
+            original = init_db.DB_PATH
+            init_db.DB_PATH = path
+            try:
+                init_db.init_db()
+                conn = sqlite3.connect(path)
+                conn.execute("INSERT INTO participants (name, password) VALUES ('Agent', 'x')")
+                conn.execute("INSERT INTO contest_events (ts, kind, name) VALUES (1, 'login', 'Agent')")
+                conn.commit()
+                stamp = conn.execute('PRAGMA user_version').fetchone()[0]
+                people = conn.execute('SELECT COUNT(*) FROM person').fetchone()[0]
+
+                init_db.reset_game()
+                names = [row[0] for row in conn.execute('SELECT name FROM participants')]
+                self.assertEqual(names, ['Query_clash'])
+                self.assertEqual(conn.execute('SELECT COUNT(*) FROM person').fetchone()[0], people)
+                self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], stamp)
+
+                # The event log outlives the reset, which it records, unless history is cleared too
+                events = conn.execute('SELECT kind, name, data FROM contest_events ORDER BY id').fetchall()
+                self.assertEqual(events, [('login', 'Agent', None), ('admin', None, '{"action":"reset_game"}')])
+                init_db.reset_game(clear_history=True)
+                events = conn.execute('SELECT kind, data FROM contest_events').fetchall()
+                self.assertEqual(events, [('admin', '{"action":"reset_game"}')])
+                conn.close()
+            finally:
+                init_db.DB_PATH = original
+
+    def test_query_pool_is_read_only_and_reused(self):
+        self.login()
+        self.app.post('/api/query', json={'sql': 'SELECT 1'})
+        conn = query_pool.acquire()
+        try:
+            # Denied by the authorizer first, and by mode=ro underneath it
+            with self.assertRaises(sqlite3.DatabaseError):
+                conn.execute("UPDATE participants SET query_count = 0 WHERE name = 'TestAgent'")
+            conn.set_authorizer(None)
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("UPDATE participants SET query_count = 0 WHERE name = 'TestAgent'")
+        finally:
+            conn.set_authorizer(app_module.player_authorizer(conn))
+            query_pool.release(conn)
+        # Released connections are reused, not reopened
+        self.assertIs(query_pool.acquire(), conn)
+        query_pool.release(conn)
+
+        # A dataset change closes them and the pool opens fresh ones
+        app_module._invalidate_dataset('test-version')
+        fresh = query_pool.acquire()
+        self.assertIsNot(fresh, conn)
+        query_pool.release(fresh)
+
 if __name__ == '__main__':
     with open('test_output.txt', 'w') as f:
         runner = unittest.TextTestRunner(stream=f, verbosity=2)